@@ -0,0 +1,78 @@
+"""Throughput benchmark for the line report.
+
+Builds synthetic patients, then times building the line rows and, optionally, writing the line
+output workbook, reporting lines per second.
+
+    python benchmark.py --lines 100000 --write out_dir
+"""
+
+from datetime import datetime, timedelta
+
+import argparse
+import random
+import sys
+import time
+
+import utils
+
+
+def synthetic_patients(lines, seed=0):
+    """Returns a dictionary of random Patients with about lines Lines, with visits and events."""
+    r = random.Random(seed)
+    start = datetime(2015, 1, 1)
+    patients = {}
+    p_id = 0
+    line_id = 0
+    while line_id < lines:
+        p_id += 1
+        p = patients[p_id] = utils.Patient(p_id)
+        first = start + timedelta(days=r.randint(0, 700), hours=r.randint(0, 23))
+        for _ in range(min(r.randint(1, 4), lines - line_id)):
+            line_id += 1
+            in_date = first + timedelta(days=r.randint(0, 30), hours=r.randint(0, 23))
+            out_date = in_date + timedelta(days=r.randint(0, 90), hours=r.randint(0, 23))
+            p.add_line(utils.Line(line_id, r.choice(['PICC', 'Port', 'Tunneled']), r.randint(1, 3), in_date,
+                                  out_date, r.choice([None, 'Complete', 'Infection']), datetime.min, datetime.max))
+        for _ in range(r.randint(0, 3)):
+            in_date = first + timedelta(days=r.randint(0, 60), hours=r.randint(0, 23))
+            p.add_visit(utils.Visit(p, in_date, in_date + timedelta(days=r.randint(1, 14))))
+        for _ in range(r.randint(0, 2)):
+            utils.add_clabsi(p, first + timedelta(days=r.randint(0, 90), hours=r.randint(0, 23)))
+        for l in p.lines:
+            if r.random() < 0.2:
+                utils.add_clanc(p, l.line_id, l.in_date + (l.out_date - l.in_date) / 2)
+    return patients
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Central Line Event Calculator line report throughput.")
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--write', metavar='DIRECTORY', help="also write the line output workbook here")
+    args = parser.parse_args(argv)
+
+    patients = synthetic_patients(args.lines, args.seed)
+    utils.build_patient_rows(patients, datetime.min, datetime.max)
+
+    started = time.perf_counter()
+    rows = utils.build_line_rows(patients)
+    seconds = time.perf_counter() - started
+    print("line rows:     {} lines in {:.3f}s, {:,.0f} lines/s".format(len(rows), seconds, len(rows) / seconds))
+
+    summary = utils.StratifiedSummary(utils.STRATA)
+    started = time.perf_counter()
+    utils.build_line_rows(patients, summary)
+    seconds = time.perf_counter() - started
+    print("with strata:   {} lines in {:.3f}s, {:,.0f} lines/s".format(len(rows), seconds, len(rows) / seconds))
+
+    if args.write:
+        results = utils.Results(patients, [], rows, None)
+        started = time.perf_counter()
+        utils.write_line_output('Benchmark', args.write, results)
+        seconds = time.perf_counter() - started
+        print("line output:   {} lines in {:.3f}s, {:,.0f} lines/s".format(len(rows), seconds, len(rows) / seconds))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
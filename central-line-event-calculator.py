@@ -3,6 +3,7 @@ from tkinter import ttk, filedialog
 from datetime import datetime
 
 from utils import *
+from jobs import BackgroundScheduler, ReportJob, FAILED
 import os, sys
 
 ###Options###
@@ -26,18 +27,24 @@ def analyze(*args):
         return
 
     # verify_admit_data(admit_entry.get())
-    try:
-        process_data(title, admit, line, clabsi, clanc, output, start_range, end_range)
-    except BadFormatException as e:
-        error_message("Invalid SpreadSheet Format", str(e))
+    job = ReportJob(title, admit, line, clabsi, clanc, output, start_range, end_range)
+    print("queued " + title)
+    check_job(job, scheduler.submit(job))
+
+def check_job(job, future):
+    """Polls a queued job from the Tk event loop and reports it when finished."""
+    if not future.done():
+        root.after(500, check_job, job, future)
+        return
+    print(job.summary())
+    if job.status == FAILED:
+        if isinstance(job.error, BadFormatException):
+            error_message("Invalid SpreadSheet Format", str(job.error))
+        else:
+            error_message("Execution Error", str(job.error))
         return
-    # except Exception as e:
-    #     #comment out for terminal tracebacks.
-    #     #always uncomment for production releases.
-    #     error_message("Execution Error", str(e))
-    #     return
 
-    os.startfile(output)
+    os.startfile(job.output)
 
 def admit_path(*args):
     admit_data_loc = get_file_path("Patient Admission Data")
@@ -66,6 +73,7 @@ def output_path(*args):
 
 
 print("Loading graphics...")
+scheduler = BackgroundScheduler(workers=2)
 root = Tk()
 root.title("Central Line Event Calculator")
 
@@ -0,0 +1,264 @@
+"""Job queue for running many Central Line Event Calculator reports concurrently.
+
+Jobs are scheduled on an asyncio event loop and analysed on a bounded pool of worker threads. Input
+files are hashed, and each distinct file is parsed once and shared by every queued job that uses it.
+Queued jobs with the same inputs, date range, cohort and options share one analysis, and each job writes
+its own output files.
+
+    python jobs.py jobs.json
+
+where jobs.json is a list of objects with the ReportJob arguments, dates as YYYY-MM-DD.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import argparse
+import asyncio
+import hashlib
+import json
+import sys
+import threading
+import time
+
+from utils import (analyze_data, load_rows, parse_date_range, read_cohort, write_patient_output, write_line_output,
+                   write_time_series_output)
+
+#  Job states, in the order a job moves through them
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class ReportJob:
+    """A request for one set of output workbooks, with its status and timing."""
+
+    def __init__(self, title, admit, line, clabsi, clanc, output, start_range=datetime.min, end_range=datetime.max,
+                 time_series=None, cohort=None):
+        self.title = title
+        self.inputs = (admit, line, clabsi, clanc)
+        self.output = output
+        self.start_range = start_range
+        self.end_range = end_range
+        self.time_series = time_series
+        self.cohort = read_cohort(cohort) if isinstance(cohort, str) else cohort
+
+        self.status = QUEUED
+        self.shared = False  # True when the analysis was shared with an identical earlier job
+        self.error = None
+        self.results = None
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.finished = None  # future set by the JobScheduler when the job finishes
+
+    def wait_time(self):
+        """Returns the seconds the job spent queued."""
+        return (self.started_at or time.time()) - self.queued_at
+
+    def run_time(self):
+        """Returns the seconds the job has been running, or took to run."""
+        if self.started_at is None:
+            return 0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def summary(self):
+        """Returns a one line description of the job status and timing."""
+        text = '{}: {} (queued {:.1f}s, ran {:.1f}s)'.format(self.title, self.status, self.wait_time(),
+                                                             self.run_time())
+        if self.shared:
+            text += ' shared analysis'
+        if self.error is not None:
+            text += ' - ' + str(self.error)
+        return text
+
+
+def file_hash(path):
+    """Returns the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class JobScheduler:
+    """Schedules ReportJobs on the running asyncio event loop with at most workers analyses at a time.
+
+    Parsed files and analyses are shared only between jobs that are queued or running at the same time:
+    each entry is dropped when the last job using it finishes, and failures are never reused.
+    """
+
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = []  # jobs that are queued or running
+        self.rows = {}  # file hash -> [future of the parsed rows, number of analyses using it]
+        self.analyses = {}  # analysis key -> [future of the Results, number of jobs using it]
+        self.outputs = {}  # title and output directory -> latest job writing them
+
+    async def run_in_worker(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def submit(self, job):
+        """Runs a job to completion and returns it. Failed jobs have status FAILED and keep their error."""
+        self.jobs.append(job)
+        job.finished = asyncio.get_running_loop().create_future()
+        try:
+            await self.run(job)
+        except Exception as e:
+            job.status = FAILED
+            job.error = e
+            job.finished_at = time.time()
+        finally:
+            self.jobs.remove(job)
+        job.finished.set_result(job)
+        return job
+
+    async def run(self, job):
+        hashes = [await self.run_in_worker(file_hash, path) for path in job.inputs]
+        cohort = frozenset(job.cohort) if job.cohort is not None else None
+        key = (tuple(hashes), job.start_range, job.end_range, job.time_series, cohort)
+
+        #  jobs writing the same files write them one at a time
+        target = (job.title, job.output)
+        earlier = self.outputs.get(target)
+        self.outputs[target] = job
+        try:
+            if earlier is not None:
+                await earlier.finished
+            analysis, shared = self.share(self.analyses, key, lambda: self.analyze(job, hashes))
+            try:
+                results = await analysis
+                job.status = RUNNING
+                job.started_at = job.started_at or time.time()
+                await self.run_in_worker(write_outputs, job, results)
+            finally:
+                self.release(self.analyses, key, analysis)
+        finally:
+            if self.outputs.get(target) is job:
+                del self.outputs[target]
+        job.shared = shared
+        self.finish(job, results)
+
+    def share(self, cache, key, create):
+        """Returns the future cached under key, creating it when there is none, and whether it existed."""
+        entry = cache.get(key)
+        shared = entry is not None
+        if not shared:
+            future = asyncio.ensure_future(create())
+            entry = cache[key] = [future, 0]
+            future.add_done_callback(lambda f: self.discard_failure(cache, key, f))
+        entry[1] += 1
+        return entry[0], shared
+
+    def release(self, cache, key, future):
+        """Drops the cached future when its last user has finished with it."""
+        entry = cache.get(key)
+        if entry is not None and entry[0] is future:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del cache[key]
+
+    def discard_failure(self, cache, key, future):
+        entry = cache.get(key)
+        if entry is not None and entry[0] is future and (future.cancelled() or future.exception() is not None):
+            del cache[key]
+
+    def finish(self, job, results):
+        job.results = results
+        job.status = DONE
+        job.started_at = job.started_at or time.time()
+        job.finished_at = time.time()
+        return job
+
+    async def analyze(self, job, hashes):
+        """Returns the Results for a job, parsing each input file only once while jobs share it."""
+        sources = []
+        parsed = []
+        try:
+            for path, digest in zip(job.inputs, hashes):
+                rows, _ = self.share(self.rows, digest, lambda path=path: self.run_in_worker(load_rows, path))
+                parsed.append((digest, rows))
+                sources.append(await rows)
+            job.status = RUNNING
+            job.started_at = time.time()
+            return await self.run_in_worker(run_analysis, job, sources)
+        finally:
+            for digest, rows in parsed:
+                self.release(self.rows, digest, rows)
+
+    def status(self):
+        """Returns the summary line of every queued or running job."""
+        return [job.summary() for job in self.jobs]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def run_analysis(job, sources):
+    return analyze_data(*sources, start_range=job.start_range, end_range=job.end_range,
+                        time_series=job.time_series, cohort=job.cohort)
+
+
+def write_outputs(job, results):
+    write_patient_output(job.title, job.output, results)
+    write_line_output(job.title, job.output, results)
+    if job.time_series:
+        write_time_series_output(job.title, job.output, results)
+
+
+class BackgroundScheduler:
+    """Runs a JobScheduler on an event loop in a background thread, for callers without an event loop."""
+
+    def __init__(self, workers=2):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.scheduler = asyncio.run_coroutine_threadsafe(self.create(workers), self.loop).result()
+
+    async def create(self, workers):
+        return JobScheduler(workers)
+
+    def submit(self, job):
+        """Queues a job. Returns a concurrent.futures.Future of the finished job."""
+        return asyncio.run_coroutine_threadsafe(self.scheduler.submit(job), self.loop)
+
+    def status(self):
+        return self.scheduler.status()
+
+
+async def run_jobs(jobs, workers=2):
+    """Runs ReportJobs concurrently and returns them once all have finished."""
+    scheduler = JobScheduler(workers)
+    try:
+        return await asyncio.gather(*[scheduler.submit(job) for job in jobs])
+    finally:
+        scheduler.shutdown()
+
+
+def read_jobs(path):
+    """Returns the ReportJobs listed in a JSON file."""
+    with open(path) as f:
+        specs = json.load(f)
+    jobs = []
+    for spec in specs:
+        spec['start_range'], spec['end_range'] = parse_date_range(spec.get('start_range'), spec.get('end_range'))
+        jobs.append(ReportJob(**spec))
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a file of Central Line Event Calculator report jobs.")
+    parser.add_argument('jobs', help="JSON list of jobs")
+    parser.add_argument('--workers', type=int, default=2, help="analyses run at the same time")
+    args = parser.parse_args(argv)
+
+    jobs = asyncio.run(run_jobs(read_jobs(args.jobs), args.workers))
+    for job in jobs:
+        print(job.summary())
+    return 1 if any(job.status == FAILED for job in jobs) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""Profiling report mode for the Central Line Event Calculator analysis.
+
+Times the readers, the catheter day calculations and the writers while a normal run writes its
+output, and lists the patients whose day calculations took longest.
+
+    python profiling.py admit.xlsx line.xlsx clabsi.xlsx clanc.xlsx out_dir --title "Project" --memory
+"""
+
+import argparse
+import functools
+import sys
+import time
+import tracemalloc
+
+import utils
+
+#  Functions of utils that are timed, in the order they run
+PROFILED = [
+    'read_line_data',
+    'read_patient_data',
+    'read_clabsi_data',
+    'read_clanc_data',
+    'calculate_inpatient_line_days',
+    'calculate_cath_day_sets',
+    'write_patient_output',
+    'write_line_output',
+    'write_time_series_output',
+]
+
+#  Functions taking a Patient first, whose time is also added up per patient
+PER_PATIENT = ['calculate_inpatient_line_days', 'calculate_cath_day_sets']
+
+
+class FunctionStats:
+    """Calls, cumulative time and memory allocated by one profiled function."""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.blocks = 0  # net memory blocks still allocated after the calls
+        self.bytes = 0  # net bytes still allocated after the calls, when tracing memory
+        self.peak = 0  # largest allocation above the starting point during one call, when tracing memory
+
+
+class PatientStats:
+    """Time spent on one patient's day calculations and the size of the patient."""
+
+    def __init__(self, p):
+        self.patient_id = p.patient_id
+        self.seconds = 0.0
+        self.lines = len(p.lines)
+        self.visits = len(p.visits)
+        self.events = len(p.clabsis) + len(p.clancs)
+        self.longest_line = max([l.total_time.days for l in p.lines] or [0])
+
+
+class Profiler:
+    """Replaces the PROFILED functions of utils with timed versions while it is active."""
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.functions = dict((name, FunctionStats(name)) for name in PROFILED)
+        self.patients = {}
+        self.originals = {}
+        self.seconds = 0.0
+
+    def __enter__(self):
+        if self.memory:
+            tracemalloc.start()
+        for name in PROFILED:
+            self.originals[name] = getattr(utils, name)
+            setattr(utils, name, self.wrap(name, self.originals[name]))
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.started
+        for name, function in self.originals.items():
+            setattr(utils, name, function)
+        if self.memory:
+            tracemalloc.stop()
+        return False
+
+    def wrap(self, name, function):
+        stats = self.functions[name]
+        per_patient = name in PER_PATIENT
+
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            blocks = sys.getallocatedblocks()
+            if self.memory:
+                start_bytes = tracemalloc.get_traced_memory()[0]
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                stats.calls += 1
+                stats.seconds += seconds
+                stats.blocks += sys.getallocatedblocks() - blocks
+                if self.memory:
+                    current, peak = tracemalloc.get_traced_memory()
+                    stats.bytes += current - start_bytes
+                    stats.peak = max(stats.peak, peak - start_bytes)
+                if per_patient:
+                    p = args[0]
+                    if p.patient_id not in self.patients:
+                        self.patients[p.patient_id] = PatientStats(p)
+                    self.patients[p.patient_id].seconds += seconds
+        return profiled
+
+    def report(self, outliers=20):
+        """Returns the profile as readable text."""
+        lines = ['Central Line Event Calculator profile', '',
+                 'Total run time: {:.3f}s'.format(self.seconds), '']
+        header = '{:<32}{:>10}{:>12}{:>12}{:>14}'.format('Function', 'Calls', 'Total (s)', 'Mean (ms)', 'Net Blocks')
+        if self.memory:
+            header += '{:>14}{:>14}'.format('Net KiB', 'Peak KiB')
+        lines += [header, '-' * len(header)]
+        for name in PROFILED:
+            stats = self.functions[name]
+            if not stats.calls:
+                continue
+            line = '{:<32}{:>10}{:>12.3f}{:>12.3f}{:>14}'.format(
+                name, stats.calls, stats.seconds, stats.seconds / stats.calls * 1000, stats.blocks)
+            if self.memory:
+                line += '{:>14.1f}{:>14.1f}'.format(stats.bytes / 1024, stats.peak / 1024)
+            lines.append(line)
+
+        slowest = sorted(self.patients.values(), key=lambda s: s.seconds, reverse=True)[:outliers]
+        lines += ['', 'Slowest patients (catheter and inpatient line day calculations)', '']
+        header = '{:<16}{:>12}{:>8}{:>8}{:>8}{:>22}'.format('Patient ID', 'Time (ms)', 'Lines', 'Visits', 'Events',
+                                                          'Longest Line (days)')
+        lines += [header, '-' * len(header)]
+        for s in slowest:
+            lines.append('{:<16}{:>12.3f}{:>8}{:>8}{:>8}{:>22}'.format(
+                str(s.patient_id), s.seconds * 1000, s.lines, s.visits, s.events, s.longest_line))
+        return '\n'.join(lines) + '\n'
+
+
+def profile_process_data(title, admit_path, line_path, clabsi_path, clanc_path, out_path, start_range, end_range,
+                         memory=False, outliers=20, **options):
+    """Runs process_data under a Profiler. Returns the profile report text.
+
+    memory also traces allocated bytes, which slows the run down considerably.
+    """
+    with Profiler(memory) as profiler:
+        utils.process_data(title, admit_path, line_path, clabsi_path, clanc_path, out_path, start_range, end_range,
+                           **options)
+    return profiler.report(outliers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile a Central Line Event Calculator run.")
+    parser.add_argument('admit')
+    parser.add_argument('line')
+    parser.add_argument('clabsi')
+    parser.add_argument('clanc')
+    parser.add_argument('output', help="output directory")
+    parser.add_argument('--title', default='Profile')
+    parser.add_argument('--start', help="start of the date range, YYYY-MM-DD")
+    parser.add_argument('--end', help="end of the date range, YYYY-MM-DD")
+    parser.add_argument('--report', help="file to write the report to, as well as printing it")
+    parser.add_argument('--outliers', type=int, default=20, help="number of slowest patients listed")
+    parser.add_argument('--memory', action='store_true', help="trace allocated memory (slower)")
+    args = parser.parse_args(argv)
+
+    start_range, end_range = utils.parse_date_range(args.start, args.end)
+    report = profile_process_data(args.title, args.admit, args.line, args.clabsi, args.clanc, args.output,
+                                  start_range, end_range, memory=args.memory, outliers=args.outliers)
+    print(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
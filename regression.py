@@ -0,0 +1,194 @@
+"""Golden output regression checks for Central Line Event Calculator results.
+
+Records the result tables of a canonically ordered analysis to a JSON file with one row per line, and
+compares later runs, or several implementations of the analysis, against it.
+
+    python regression.py record golden.json admit.xlsx line.xlsx clabsi.xlsx clanc.xlsx
+    python regression.py check golden.json admit.xlsx line.xlsx clabsi.xlsx clanc.xlsx --tolerance 1e-12
+
+--engines also checks that the SQLite store and snapshot engines give the same tables as analyze_data.
+The golden directory holds a small synthetic extract and its recorded results:
+
+    python regression.py check golden/golden.json golden/admit.xlsx golden/line.xlsx golden/clabsi.xlsx
+        golden/clanc.xlsx --engines
+"""
+
+from datetime import datetime, date
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from snapshot import Snapshot, snapshot_files
+from store import PatientStore
+from utils import analyze_data, parse_date_range
+
+#  Result tables in the order they are written, as (table name, Results attribute).
+TABLES = [
+    ('patient', 'patient_rows'),
+    ('totals', 'totals'),
+    ('line', 'line_rows'),
+    ('stratified', 'stratum_rows'),
+    ('attribution', 'attribution_rows'),
+    ('time_series', 'time_series_rows'),
+    ('anomalies', 'anomaly_rows'),
+]
+
+
+def results_tables(results):
+    """Returns a dictionary of the result tables as lists of JSON compatible row lists."""
+    tables = {}
+    for name, attr in TABLES:
+        rows = getattr(results, attr)
+        if name == 'totals':
+            rows = [rows]
+        tables[name] = [[plain_value(v) for v in row] for row in rows]
+    return tables
+
+
+def plain_value(value):
+    """Returns dates as ISO format text and any other value unchanged."""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def write_golden(results, path):
+    """Writes the result tables to a golden file. The same results always produce the same bytes."""
+    tables = results_tables(results)
+    with open(path, 'w', newline='\n') as golden:
+        golden.write('{\n')
+        for i, (name, _) in enumerate(TABLES):
+            golden.write(json.dumps(name) + ': [\n')
+            rows = tables[name]
+            golden.write(',\n'.join(json.dumps(row) for row in rows))
+            golden.write('\n]' if rows else ']')
+            golden.write(',\n' if i < len(TABLES) - 1 else '\n')
+        golden.write('}\n')
+
+
+def read_golden(path):
+    """Returns the result tables stored in a golden file."""
+    with open(path) as golden:
+        return json.load(golden)
+
+
+def compare_tables(expected, actual, tolerance=0.0):
+    """Returns a list of differences between two sets of result tables.
+
+    Numbers match when they differ by no more than tolerance relative to their size (or absolutely,
+    below 1). All other values must be equal.
+    """
+    differences = []
+    for name, _ in TABLES:
+        expected_rows = expected.get(name, [])
+        actual_rows = actual.get(name, [])
+        if len(expected_rows) != len(actual_rows):
+            differences.append('{}: expected {} rows, found {}'.format(name, len(expected_rows), len(actual_rows)))
+        for row, (expected_row, actual_row) in enumerate(zip(expected_rows, actual_rows)):
+            for column, (e, a) in enumerate(zip(expected_row, actual_row)):
+                if not values_match(e, a, tolerance):
+                    differences.append('{} row {} column {}: expected {!r}, found {!r}'.format(
+                        name, row + 1, column + 1, e, a))
+    return differences
+
+
+def values_match(expected, actual, tolerance):
+    """Returns True if two table values are equal, or are numbers within tolerance."""
+    numbers = (int, float)
+    if isinstance(expected, numbers) and isinstance(actual, numbers) \
+            and not isinstance(expected, bool) and not isinstance(actual, bool):
+        return abs(expected - actual) <= tolerance * max(1, abs(expected), abs(actual))
+    return expected == actual
+
+
+def compare_engines(inputs, engines, start_range=datetime.min, end_range=datetime.max, tolerance=0.0):
+    """Runs each engine over the same inputs and compares its results with those of the first engine.
+
+    inputs is the (admit, line, clabsi, clanc) paths or row lists. engines is a list of (name, function)
+    pairs where function takes the same arguments as analyze_data and returns a Results object.
+    Returns a dictionary of the differences found for each engine after the first.
+    """
+    inputs = [list(source) if not isinstance(source, str) else source for source in inputs]
+    reference = None
+    differences = {}
+    for name, engine in engines:
+        tables = results_tables(engine(*inputs, start_range=start_range, end_range=end_range, canonical=True,
+                                       time_series=1))
+        if reference is None:
+            reference = tables
+        else:
+            differences[name] = compare_tables(reference, tables, tolerance)
+    return differences
+
+
+def store_engine(admit, line, clabsi, clanc, start_range=datetime.min, end_range=datetime.max, **options):
+    """Analyses an extract through an in-memory PatientStore."""
+    store = PatientStore(':memory:')
+    try:
+        store.ingest(admit, line, clabsi, clanc)
+        return store.analyze(start_range, end_range, **options)
+    finally:
+        store.close()
+
+
+def snapshot_engine(admit, line, clabsi, clanc, start_range=datetime.min, end_range=datetime.max, **options):
+    """Analyses an extract through a temporary snapshot file."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'extract.snap')
+    try:
+        snapshot_files(admit, line, clabsi, clanc, path)
+        with Snapshot(path) as snapshot:
+            return snapshot.analyze(start_range, end_range, **options)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(directory)
+
+
+#  Implementations of the analysis checked against each other, the reference first
+ENGINES = [
+    ('analyze_data', analyze_data),
+    ('store', store_engine),
+    ('snapshot', snapshot_engine),
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record or check golden Central Line Event Calculator results.")
+    parser.add_argument('mode', choices=['record', 'check'])
+    parser.add_argument('golden', help="golden results file")
+    parser.add_argument('admit')
+    parser.add_argument('line')
+    parser.add_argument('clabsi')
+    parser.add_argument('clanc')
+    parser.add_argument('--start', help="start of the date range, YYYY-MM-DD")
+    parser.add_argument('--end', help="end of the date range, YYYY-MM-DD")
+    parser.add_argument('--tolerance', type=float, default=0.0, help="relative tolerance for numbers")
+    parser.add_argument('--engines', action='store_true', help="also compare the store and snapshot engines")
+    args = parser.parse_args(argv)
+
+    start_range, end_range = parse_date_range(args.start, args.end)
+    results = analyze_data(args.admit, args.line, args.clabsi, args.clanc, start_range, end_range,
+                           canonical=True, time_series=1)
+
+    if args.mode == 'record':
+        write_golden(results, args.golden)
+        print("recorded " + args.golden)
+        return 0
+
+    differences = compare_tables(read_golden(args.golden), results_tables(results), args.tolerance)
+    if args.engines:
+        inputs = (args.admit, args.line, args.clabsi, args.clanc)
+        for name, found in compare_engines(inputs, ENGINES, start_range, end_range, args.tolerance).items():
+            differences += [name + ' ' + difference for difference in found]
+    for difference in differences:
+        print(difference)
+    print("{} differences".format(len(differences)))
+    return 1 if differences else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
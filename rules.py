@@ -0,0 +1,106 @@
+"""Compare attribution rule sets over one Central Line Event Calculator extract.
+
+Each input spreadsheet is parsed and the lines built once; every rule set then re-reads only the visits
+and events from the parsed rows and recalculates the days and rates. The default rules are
+always compared first. A rules file is a JSON object of Rules settings, for example:
+
+    {"name": "Removed within 2 days", "line_removal_days": 2, "min_admit_hours": 48}
+
+    python rules.py admit.xlsx line.xlsx clabsi.xlsx clanc.xlsx strict.json loose.json --output out_dir
+"""
+
+from datetime import datetime
+
+import argparse
+import sys
+
+from utils import (DEFAULT_RULES, analyze_patients, load_rows, parse_date_range, read_cohort, read_rules,
+                   read_line_data, read_patient_data, read_clabsi_data, read_clanc_data, write_patient_output,
+                   write_line_output, write_time_series_output)
+
+#  Population totals compared between rule sets, as (PatientRow field, heading)
+COMPARED = [
+    ('inpatient_cath_days', 'Inpatient Cath Days'),
+    ('clabsis', 'CLABSIs'),
+    ('inpatient_clabsis', 'Inpatient CLABSIs'),
+    ('inpatient_clabsi_rate', 'Inpatient CLABSI Rate'),
+    ('clabsi_rate', 'CLABSI Rate'),
+    ('inpatient_clancs', 'Inpatient CLANCs'),
+    ('inpatient_clanc_rate', 'Inpatient CLANC Rate'),
+]
+
+
+def compare_rules(admit, line, clabsi, clanc, rule_sets, start_range=datetime.min, end_range=datetime.max,
+                  cohort=None, **options):
+    """Returns a list of (Rules, Results) for each rule set, parsing the inputs and building the lines once.
+
+    Inputs and cohort are those of analyze_data. rule_sets are Rules or paths of rules files. options
+    are the strata, time_series and canonical options of analyze_data. Every Results shares the same
+    Patients, which hold the attribution of the last rule set.
+    """
+    if isinstance(cohort, str):
+        cohort = read_cohort(cohort)
+    elif cohort is not None:
+        cohort = set(cohort)
+    admit, clabsi, clanc = [load_rows(source) if isinstance(source, str) else list(source)
+                            for source in (admit, clabsi, clanc)]
+    patients = read_line_data(line, start_range, end_range, cohort)
+    compared = []
+    for rules in rule_sets:
+        if isinstance(rules, str):
+            rules = read_rules(rules)
+        for p in patients.values():
+            p.clear_attribution()
+        read_patient_data(admit, patients, start_range, end_range, cohort, rules)
+        read_clabsi_data(clabsi, patients, start_range, end_range, cohort, rules)
+        read_clanc_data(clanc, patients, start_range, end_range, cohort, rules)
+        compared.append((rules, analyze_patients(patients, start_range, end_range, **options)))
+    return compared
+
+
+def comparison_report(compared):
+    """Returns the population totals of each rule set as readable text."""
+    header = '{:<28}'.format('Rule Set') + ''.join('{:>24}'.format(name) for _, name in COMPARED)
+    lines = [header, '-' * len(header)]
+    for rules, results in compared:
+        line = '{:<28}'.format(rules.name[:27])
+        for field, _ in COMPARED:
+            value = getattr(results.totals, field)
+            line += '{:>24.3f}'.format(value) if isinstance(value, float) else '{:>24}'.format(value)
+        lines.append(line)
+    lines.append('')
+    for rules, _ in compared:
+        lines.append(rules.name + ': ' + ', '.join('{}={}'.format(key, value) for key, value in rules.settings))
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare attribution rule sets over one extract.")
+    parser.add_argument('admit')
+    parser.add_argument('line')
+    parser.add_argument('clabsi')
+    parser.add_argument('clanc')
+    parser.add_argument('rules', nargs='*', help="JSON files of attribution rules")
+    parser.add_argument('--start', help="start of the date range, YYYY-MM-DD")
+    parser.add_argument('--end', help="end of the date range, YYYY-MM-DD")
+    parser.add_argument('--output', help="also write each rule set's output workbooks to this directory")
+    parser.add_argument('--title', default='Rules')
+    parser.add_argument('--time-series', type=int, help="days per row of a time series output")
+    args = parser.parse_args(argv)
+
+    start_range, end_range = parse_date_range(args.start, args.end)
+    compared = compare_rules(args.admit, args.line, args.clabsi, args.clanc, [DEFAULT_RULES] + args.rules,
+                             start_range, end_range, time_series=args.time_series)
+    print(comparison_report(compared))
+    if args.output:
+        for rules, results in compared:
+            title = args.title + ' - ' + rules.name
+            write_patient_output(title, args.output, results)
+            write_line_output(title, args.output, results)
+            if args.time_series:
+                write_time_series_output(title, args.output, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
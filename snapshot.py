@@ -0,0 +1,285 @@
+"""Memory-mapped columnar snapshots of parsed Central Line Event Calculator data.
+
+A snapshot stores every Patient's lines, visits and events as flat typed columns, with offset columns
+giving each patient's slice of the line, visit, CLABSI and CLANC columns. Opening a snapshot maps the
+file and exposes the columns as memoryviews without copying or deserialising anything.
+
+File layout: the 8 byte magic, a little endian uint64 header length, a JSON header describing each
+column (typecode, byte offset and count), then the column data, each column aligned to 8 bytes.
+Dates are stored as int32 day ordinals with an int64 microsecond-of-day column beside them.
+
+    python snapshot.py write data.snap admit.xlsx line.xlsx clabsi.xlsx clanc.xlsx
+    python snapshot.py info data.snap
+"""
+
+from array import array
+from datetime import datetime, timedelta
+
+import argparse
+import json
+import mmap
+import struct
+import sys
+
+import utils
+
+MAGIC = b'CLECSNAP'
+VERSION = 1
+
+#  Snapshots keep every visit, so any attribution Rules can be applied when they are analysed
+ALL_VISITS = utils.Rules('All visits', min_admit_hours=0)
+
+#  Column names and array typecodes: q is int64, i is int32, B is a byte.
+COLUMNS = [
+    ('patient_id', 'q'),
+    ('line_start', 'q'),
+    ('visit_start', 'q'),
+    ('clabsi_start', 'q'),
+    ('clanc_start', 'q'),
+    ('line_id', 'q'),
+    ('line_lumens', 'i'),
+    ('line_type', 'i'),
+    ('line_removal_reason', 'i'),
+    ('line_in_day', 'i'),
+    ('line_in_time', 'q'),
+    ('line_out_day', 'i'),
+    ('line_out_time', 'q'),
+    ('visit_in_day', 'i'),
+    ('visit_in_time', 'q'),
+    ('visit_out_day', 'i'),
+    ('visit_out_time', 'q'),
+    ('clabsi_day', 'i'),
+    ('clabsi_time', 'q'),
+    ('clanc_line_id', 'q'),
+    ('clanc_day', 'i'),
+    ('clanc_time', 'q'),
+    ('string_start', 'q'),
+    ('string_data', 'B'),
+]
+
+
+def split_date(value):
+    """Returns the day ordinal and microsecond of the day of a datetime."""
+    return value.toordinal(), ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 + value.microsecond
+
+
+def join_date(day, microsecond):
+    """Returns the datetime of a day ordinal and microsecond of the day."""
+    return datetime.fromordinal(day) + timedelta(microseconds=microsecond)
+
+
+def write_snapshot(patients, path):
+    """Writes a dictionary of Patients to a snapshot file.
+
+    Patient IDs must be integers. The Patients should be read with the full date range, otherwise
+    lines are stored clipped to it, and with ALL_VISITS, otherwise short visits are left out.
+    """
+    columns = dict((name, array(typecode)) for name, typecode in COLUMNS)
+    strings = {}
+
+    def string_index(text):
+        if text is None:
+            return -1
+        if text not in strings:
+            strings[text] = len(strings)
+        return strings[text]
+
+    def add_date(prefix, value):
+        day, microsecond = split_date(value)
+        columns[prefix + '_day'].append(day)
+        columns[prefix + '_time'].append(microsecond)
+
+    for name in ('line_start', 'visit_start', 'clabsi_start', 'clanc_start'):
+        columns[name].append(0)
+    for p_id, p in patients.items():
+        if not isinstance(p_id, int):
+            raise utils.BadFormatException("Snapshots require numeric Patient IDs, found " + repr(p_id))
+        columns['patient_id'].append(p_id)
+        for l in p.lines:
+            columns['line_id'].append(l.line_id)
+            columns['line_lumens'].append(l.lumens)
+            columns['line_type'].append(string_index(l.line_type))
+            columns['line_removal_reason'].append(string_index(l.removal_reason))
+            add_date('line_in', l.in_date)
+            add_date('line_out', l.out_date)
+        for v in p.visits:
+            add_date('visit_in', v.check_in_date)
+            add_date('visit_out', v.check_out_date)
+        for e in p.clabsis:
+            add_date('clabsi', e.date)
+        for e in p.clancs:
+            columns['clanc_line_id'].append(e.line.line_id)
+            add_date('clanc', e.date)
+        columns['line_start'].append(len(columns['line_id']))
+        columns['visit_start'].append(len(columns['visit_in_day']))
+        columns['clabsi_start'].append(len(columns['clabsi_day']))
+        columns['clanc_start'].append(len(columns['clanc_day']))
+
+    columns['string_start'].append(0)
+    for text in sorted(strings, key=strings.get):
+        columns['string_data'].frombytes(text.encode('utf-8'))
+        columns['string_start'].append(len(columns['string_data']))
+
+    header = {'version': VERSION, 'byteorder': sys.byteorder, 'columns': {}}
+    offset = 0
+    for name, typecode in COLUMNS:
+        header['columns'][name] = {'typecode': typecode, 'offset': offset, 'count': len(columns[name])}
+        offset += aligned(len(columns[name]) * columns[name].itemsize)
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    data_start = aligned(len(MAGIC) + 8 + len(header_bytes))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b'\0' * (data_start - f.tell()))
+        for name, _ in COLUMNS:
+            data = columns[name].tobytes()
+            f.write(data)
+            f.write(b'\0' * (aligned(len(data)) - len(data)))
+
+
+def aligned(size):
+    """Returns size rounded up to a multiple of 8 bytes."""
+    return (size + 7) // 8 * 8
+
+
+class Snapshot:
+    """A snapshot file mapped into memory. Columns are memoryviews into the mapping."""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise utils.BadFormatException(path + " is not a snapshot file.")
+        header_size = struct.unpack_from('<Q', self.map, len(MAGIC))[0]
+        header_start = len(MAGIC) + 8
+        self.header = json.loads(self.map[header_start:header_start + header_size].decode('utf-8'))
+        if self.header['version'] != VERSION or self.header['byteorder'] != sys.byteorder:
+            self.close()
+            raise utils.BadFormatException(path + " was written by another version or platform.")
+
+        data_start = aligned(header_start + header_size)
+        self.view = memoryview(self.map)
+        self.columns = {}
+        for name, column in self.header['columns'].items():
+            start = data_start + column['offset']
+            size = column['count'] * array(column['typecode']).itemsize
+            self.columns[name] = self.view[start:start + size].cast(column['typecode'])
+        self.strings = [bytes(self.columns['string_data'][a:b]).decode('utf-8')
+                        for a, b in zip(self.columns['string_start'], self.columns['string_start'][1:])]
+
+    def close(self):
+        """Releases the column views and unmaps the file."""
+        for column in getattr(self, 'columns', {}).values():
+            column.release()
+        self.columns = {}
+        if getattr(self, 'view', None) is not None:
+            self.view.release()
+            self.view = None
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __len__(self):
+        return len(self.columns['patient_id'])
+
+    def column(self, name):
+        """Returns a column as a memoryview of int64, int32 or byte values."""
+        return self.columns[name]
+
+    def string(self, index):
+        return self.strings[index] if index >= 0 else None
+
+    def patient_rows(self, prefix):
+        """Yields (Patient ID, start, end) for each patient's slice of the prefix columns."""
+        starts = self.columns[prefix + '_start']
+        for i, p_id in enumerate(self.columns['patient_id']):
+            yield p_id, starts[i], starts[i + 1]
+
+    def date(self, prefix, i):
+        return join_date(self.columns[prefix + '_day'][i], self.columns[prefix + '_time'][i])
+
+    def line_data(self):
+        """Yields rows in the layout of the line data spreadsheet."""
+        c = self.columns
+        for p_id, start, end in self.patient_rows('line'):
+            for i in range(start, end):
+                yield (p_id, c['line_id'][i], self.string(c['line_type'][i]), c['line_lumens'][i],
+                       self.date('line_in', i), self.date('line_out', i), None,
+                       self.string(c['line_removal_reason'][i]))
+
+    def admit_data(self):
+        """Yields rows in the layout of the patient admission spreadsheet."""
+        for p_id, start, end in self.patient_rows('visit'):
+            for i in range(start, end):
+                yield p_id, self.date('visit_in', i), self.date('visit_out', i)
+
+    def clabsi_data(self):
+        """Yields rows in the layout of the CLABSI spreadsheet."""
+        for p_id, start, end in self.patient_rows('clabsi'):
+            for i in range(start, end):
+                yield p_id, self.date('clabsi', i)
+
+    def clanc_data(self):
+        """Yields rows in the layout of the CLANC spreadsheet."""
+        c = self.columns
+        for p_id, start, end in self.patient_rows('clanc'):
+            for i in range(start, end):
+                yield p_id, c['clanc_line_id'][i], self.date('clanc', i)
+
+    def analyze(self, start_range=datetime.min, end_range=datetime.max, **options):
+        """Returns a Results object for the snapshot data.
+
+        Takes the rules, cohort, strata, time_series and canonical options of analyze_data.
+        """
+        return utils.analyze_data(self.admit_data(), self.line_data(), self.clabsi_data(), self.clanc_data(),
+                                  start_range, end_range, **options)
+
+
+def snapshot_files(admit, line, clabsi, clanc, path):
+    """Reads an extract with the full date range and every visit and writes it to a snapshot. Returns the Patients."""
+    start_range, end_range = datetime.min, datetime.max
+    patients = utils.read_line_data(line, start_range, end_range)
+    utils.read_patient_data(admit, patients, start_range, end_range, rules=ALL_VISITS)
+    utils.read_clabsi_data(clabsi, patients, start_range, end_range)
+    utils.read_clanc_data(clanc, patients, start_range, end_range)
+    write_snapshot(patients, path)
+    return patients
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Central Line Event Calculator columnar snapshots.")
+    commands = parser.add_subparsers(dest='command')
+    write = commands.add_parser('write', help="write a snapshot of an extract")
+    write.add_argument('snapshot')
+    write.add_argument('admit')
+    write.add_argument('line')
+    write.add_argument('clabsi')
+    write.add_argument('clanc')
+    info = commands.add_parser('info', help="describe a snapshot")
+    info.add_argument('snapshot')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+
+    if args.command == 'write':
+        patients = snapshot_files(args.admit, args.line, args.clabsi, args.clanc, args.snapshot)
+        print("wrote {} patients to {}".format(len(patients), args.snapshot))
+    else:
+        with Snapshot(args.snapshot) as snapshot:
+            for name, column in sorted(snapshot.header['columns'].items()):
+                print('{:<22}{:>4}{:>12}'.format(name, column['typecode'], column['count']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+"""SQLite patient store for Central Line Event Calculator data.
+
+Keeps the lines, visits and events of every ingested extract in one local database, so reports for any
+date range can be generated without reloading the spreadsheets.
+
+    python store.py ingest history.db admit.xlsx line.xlsx clabsi.xlsx clanc.xlsx
+    python store.py report history.db "Project Title" out_dir --start 2016-01-01 --end 2016-12-31
+"""
+
+from datetime import datetime
+
+import argparse
+import sqlite3
+import sys
+
+from utils import (DEFAULT_RULES, BadFormatException, Patient, Line, Visit, add_clabsi, add_clanc,
+                   analyze_patients, parse_date_range, read_cohort, read_rules, line_data_rows, admit_data_rows,
+                   clabsi_data_rows, clanc_data_rows, write_patient_output, write_line_output, write_time_series_output)
+
+#  Dates are stored as fixed width text, so text order is date order and ranges can use the indexes.
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+#  Version of the schema, kept in the database's user_version
+SCHEMA_VERSION = 3
+
+#  Rows are stored as read, before any date range, patient or rules filter. Each table's rows are identified
+#  by the columns before occurrence, which numbers rows of one extract sharing those columns, so duplicate
+#  rows are kept and a later extract replaces every stored row with the same identity.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS lines (
+    patient_id NOT NULL,
+    line_id INTEGER NOT NULL,
+    occurrence INTEGER NOT NULL,
+    line_type TEXT,
+    lumens INTEGER,
+    in_date TEXT NOT NULL,
+    out_date TEXT NOT NULL,
+    removal_reason TEXT,
+    PRIMARY KEY (patient_id, line_id, occurrence)
+);
+CREATE INDEX IF NOT EXISTS lines_line_id ON lines (line_id);
+CREATE INDEX IF NOT EXISTS lines_in_date ON lines (in_date);
+CREATE INDEX IF NOT EXISTS lines_out_date ON lines (out_date);
+CREATE TABLE IF NOT EXISTS visits (
+    patient_id NOT NULL,
+    check_in_date TEXT NOT NULL,
+    occurrence INTEGER NOT NULL,
+    check_out_date TEXT NOT NULL,
+    PRIMARY KEY (patient_id, check_in_date, occurrence)
+);
+CREATE INDEX IF NOT EXISTS visits_check_in_date ON visits (check_in_date);
+CREATE INDEX IF NOT EXISTS visits_check_out_date ON visits (check_out_date);
+CREATE TABLE IF NOT EXISTS clabsis (
+    patient_id NOT NULL,
+    clabsi_date TEXT NOT NULL,
+    occurrence INTEGER NOT NULL,
+    PRIMARY KEY (patient_id, clabsi_date, occurrence)
+);
+CREATE INDEX IF NOT EXISTS clabsis_clabsi_date ON clabsis (clabsi_date);
+CREATE TABLE IF NOT EXISTS clancs (
+    patient_id NOT NULL,
+    line_id INTEGER NOT NULL,
+    clanc_date TEXT NOT NULL,
+    occurrence INTEGER NOT NULL,
+    PRIMARY KEY (patient_id, line_id, clanc_date, occurrence)
+);
+CREATE INDEX IF NOT EXISTS clancs_line_id ON clancs (line_id);
+CREATE INDEX IF NOT EXISTS clancs_clanc_date ON clancs (clanc_date);
+"""
+
+#  Stored tables, as (table, identity columns, other columns)
+TABLES = [
+    ('lines', ('patient_id', 'line_id'), ('line_type', 'lumens', 'in_date', 'out_date', 'removal_reason')),
+    ('visits', ('patient_id', 'check_in_date'), ('check_out_date',)),
+    ('clabsis', ('patient_id', 'clabsi_date'), ()),
+    ('clancs', ('patient_id', 'line_id', 'clanc_date'), ()),
+]
+
+
+def to_text(value):
+    """Returns a datetime as stored in the database."""
+    return value.isoformat(' ', 'microseconds')
+
+
+def from_text(value):
+    """Returns the datetime of a stored date."""
+    return datetime.strptime(value, DATE_FORMAT)
+
+
+def stored_row(row):
+    """Returns a data row with its dates as stored in the database."""
+    return tuple(to_text(v) if isinstance(v, datetime) else v for v in row)
+
+
+class PatientStore:
+    """SQLite database of the line, admission, CLABSI and CLANC rows of every ingested extract."""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        tables = self.connection.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+        if tables and version != SCHEMA_VERSION:
+            self.close()
+            raise BadFormatException(path + " was written by another version of the store. "
+                                     "Ingest the extracts into a new database.")
+        self.connection.executescript(SCHEMA)
+        self.connection.execute("PRAGMA user_version = " + str(SCHEMA_VERSION))
+
+    def close(self):
+        self.connection.close()
+
+    def ingest(self, admit, line, clabsi, clanc):
+        """Adds the validated rows of an extract, replacing stored rows with the same identity.
+
+        Each input may be an Excel file path or an iterable of data rows, as for analyze_data. Every row
+        is kept whether or not its patient has lines in this extract, and every Patient ID in the extract
+        is added to the patients table. Returns the number of rows per table, and of Patient IDs.
+        """
+        sources = [line_data_rows(line), admit_data_rows(admit), clabsi_data_rows(clabsi), clanc_data_rows(clanc)]
+        counts = {}
+        patient_ids = set()
+        with self.connection:
+            for (table, identity, columns), rows in zip(TABLES, sources):
+                groups = {}
+                for row in rows:
+                    patient_ids.add(row[0])
+                    row = stored_row(row)
+                    groups.setdefault(row[:len(identity)], []).append(row[len(identity):])
+                match = ' AND '.join(name + ' = ?' for name in identity)
+                self.connection.executemany("DELETE FROM " + table + " WHERE " + match, groups.keys())
+                names = identity + ('occurrence',) + columns
+                self.connection.executemany(
+                    "INSERT INTO " + table + " (" + ', '.join(names) + ") VALUES (" + ', '.join('?' * len(names)) + ")",
+                    [key + (occurrence,) + rest for key, group in groups.items()
+                     for occurrence, rest in enumerate(group)])
+                counts[table] = sum(len(group) for group in groups.values())
+            self.connection.executemany("INSERT OR IGNORE INTO patients VALUES (?)",
+                                        [(p_id,) for p_id in patient_ids])
+        counts['patients'] = len(patient_ids)
+        return counts
+
+    def load_patients(self, start_range=datetime.min, end_range=datetime.max, rules=DEFAULT_RULES, cohort=None):
+        """Returns a dictionary of Patients with the data in the date range, as the readers would build it.
+
+        Visits and events of patients without lines in the range are skipped here, and visits are kept
+        and events attributed with rules, the attribution Rules. When a cohort set of Patient IDs is
+        given, only those patients are loaded.
+        """
+        start, end = to_text(start_range), to_text(end_range)
+        c = self.connection
+        patients = {}
+        rows = c.execute(
+            "SELECT patient_id, line_id, line_type, lumens, in_date, out_date, removal_reason FROM lines "
+            "WHERE in_date <= ? AND (in_date >= ? OR out_date >= ?) ORDER BY patient_id, in_date, line_id, occurrence",
+            (end, start, start))
+        for p_id, line_id, line_type, lumens, in_date, out_date, removal_reason in rows:
+            if cohort is not None and p_id not in cohort:
+                continue
+            if p_id not in patients:
+                patients[p_id] = Patient(p_id)
+            patients[p_id].add_line(Line(line_id, line_type, lumens, from_text(in_date), from_text(out_date),
+                                         removal_reason, start_range, end_range))
+
+        rows = c.execute(
+            "SELECT patient_id, check_in_date, check_out_date FROM visits "
+            "WHERE check_out_date >= ? AND check_in_date <= ? ORDER BY patient_id, check_in_date, occurrence",
+            (start, end))
+        for p_id, in_date, out_date in rows:
+            in_date, out_date = from_text(in_date), from_text(out_date)
+            if p_id in patients and rules.full_day_admit(in_date, out_date):
+                patients[p_id].add_visit(Visit(patients[p_id], in_date, out_date))
+
+        rows = c.execute(
+            "SELECT patient_id, clabsi_date FROM clabsis WHERE clabsi_date BETWEEN ? AND ? "
+            "ORDER BY patient_id, clabsi_date, occurrence", (start, end))
+        for p_id, clabsi_date in rows:
+            if p_id in patients:
+                add_clabsi(patients[p_id], from_text(clabsi_date), rules)
+
+        rows = c.execute(
+            "SELECT patient_id, line_id, clanc_date FROM clancs WHERE clanc_date BETWEEN ? AND ? "
+            "ORDER BY patient_id, clanc_date, line_id, occurrence", (start, end))
+        for p_id, line_id, clanc_date in rows:
+            if p_id in patients:
+                add_clanc(patients[p_id], line_id, from_text(clanc_date), rules)
+        return patients
+
+    def analyze(self, start_range=datetime.min, end_range=datetime.max, rules=DEFAULT_RULES, cohort=None,
+                **options):
+        """Returns a Results object for the stored data in the date range.
+
+        Takes the rules, cohort, strata, time_series and canonical options of analyze_data.
+        """
+        if isinstance(rules, str):
+            rules = read_rules(rules)
+        if isinstance(cohort, str):
+            cohort = read_cohort(cohort)
+        elif cohort is not None:
+            cohort = set(cohort)
+        patients = self.load_patients(start_range, end_range, rules, cohort)
+        return analyze_patients(patients, start_range, end_range, **options)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Central Line Event Calculator SQLite patient store.")
+    commands = parser.add_subparsers(dest='command')
+    ingest = commands.add_parser('ingest', help="add an extract to the store")
+    ingest.add_argument('database')
+    ingest.add_argument('admit')
+    ingest.add_argument('line')
+    ingest.add_argument('clabsi')
+    ingest.add_argument('clanc')
+    report = commands.add_parser('report', help="write the output workbooks for a date range")
+    report.add_argument('database')
+    report.add_argument('title')
+    report.add_argument('output')
+    report.add_argument('--start', help="start of the date range, YYYY-MM-DD")
+    report.add_argument('--end', help="end of the date range, YYYY-MM-DD")
+    report.add_argument('--time-series', type=int, help="days per row of a time series output")
+    report.add_argument('--rules', help="JSON file of attribution rules")
+    report.add_argument('--cohort', help="file of the Patient IDs to report on")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+
+    store = PatientStore(args.database)
+    try:
+        if args.command == 'ingest':
+            counts = store.ingest(args.admit, args.line, args.clabsi, args.clanc)
+            print("ingested " + ', '.join('{} {}'.format(counts[table], table) for table, _, _ in TABLES)
+                  + " of {} patients".format(counts['patients']))
+        else:
+            start_range, end_range = parse_date_range(args.start, args.end)
+            results = store.analyze(start_range, end_range, rules=args.rules or DEFAULT_RULES, cohort=args.cohort,
+                                    time_series=args.time_series)
+            write_patient_output(args.title, args.output, results)
+            write_line_output(args.title, args.output, results)
+            if args.time_series:
+                write_time_series_output(args.title, args.output, results)
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,16 @@
 """Classes and methods for Central Line Event Calculator analysis"""
 
-from tkinter import filedialog, messagebox
+from collections import namedtuple
 from openpyxl import Workbook, load_workbook, cell
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import PatternFill, colors
 
 from datetime import datetime, timedelta, date
 
 import functools
+import itertools
+import json
 import string
 import os
 
@@ -18,11 +21,13 @@ OPTIONS['filetypes'] = [('Excel files', '.xlsx .xls'), ('all files', '.*')]
 
 
 def error_message(title, message):
+    from tkinter import messagebox
     messagebox.showwarning(title, message)
 
 
 def get_file_path(title):
     """Opens TkInter dialogue window and returns user specefied file path."""
+    from tkinter import filedialog
     OPTIONS['title'] = title
     path = filedialog.askopenfilename(**OPTIONS)
     return path
@@ -30,6 +35,7 @@ def get_file_path(title):
 
 def get_file_directory(title):
     """Opens TkInter dialogue window and returns user specefied file directory."""
+    from tkinter import filedialog
     OPTIONS['title'] = title
     directory = filedialog.askdirectory()
     return directory
@@ -71,46 +77,430 @@ def verify_excel_file(path):
     return False
 
 
-def process_data(title, admit_path, line_path, clabsi_path, clanc_path, out_path, start_range, end_range):
-    """Read in each file and writes results to the out_path."""
+PATIENT_COLUMNS = [
+    ('patient_id', 'Patient ID'),
+    ('total_lines', 'Total Lines'),
+    ('line_days', 'Sum of all Line Days'),
+    ('inpatient_line_days', 'Inpatient Line Days'),
+    ('outpatient_line_days', 'Outpatient Line Days'),
+    ('mean_line_duration', 'Mean Duration of Line (Days)'),
+    ('cath_days', 'Total Days with any Catheter'),
+    ('cath_density', 'Catheter Density (Sum of all Line Days/Total Days with any catheter)'),
+    ('lumen_days', 'Sum of all Lumen Days'),
+    ('inpatient_lumen_days', 'Inpatient Lumen Days'),
+    ('outpatient_lumen_days', 'Outpatient Lumen Days'),
+    ('inpatient_lumen_density',
+     'Inpatient Lumen Density (Inpatient Lumen Days/Total Inpatient Days With A Catheter)'),
+    ('outpatient_lumen_density',
+     'Outpatient Lumen Density (Outpatient Lumen Days/Total Outpatient Days With A Catheter)'),
+    ('lumen_density', 'Total Lumen Density (Sum of all Lumen Days/Total Days with any catheter)'),
+    ('clabsis', 'CLABSIs'),
+    ('inpatient_clabsis', 'Inpatient CLABSIs'),
+    ('outpatient_clabsis', 'Outpatient CLABSIs'),
+    ('inpatient_clabsi_rate', 'Inpatient CLABSI Rate (x1000)'),
+    ('outpatient_clabsi_rate', 'Outpatient CLABSI Rate (x1000)'),
+    ('clabsi_rate', 'CLABSI Rate (x1000)'),
+    ('clancs', 'CLANCs'),
+    ('inpatient_clancs', 'Inpatient CLANCs'),
+    ('outpatient_clancs', 'Outpatient CLANCs'),
+    ('inpatient_clanc_rate', 'Inpatient CLANC Rate (x1000)'),
+    ('outpatient_clanc_rate', 'Outpatient CLANC Rate (x1000)'),
+    ('clanc_rate', 'CLANC Rate (x1000)'),
+    ('event_rate', 'ALL EVENT Rate (x1000)'),
+    ('inpatient_cath_days', 'Inpatient Catheter Days'),
+    ('outpatient_cath_days', 'Outpatient Catheter Days'),
+    ('inpatient_line_density', 'Inpatient Line Density'),
+    ('outpatient_line_density', 'Outpatient Line Density'),
+]
+
+LINE_COLUMNS = [
+    ('line_id', 'Line ID'),
+    ('patient_id', 'Patient ID'),
+    ('lumens', 'Number of Lumens'),
+    ('in_date', 'Date of Insertion (or first evaluation)'),
+    ('out_date', 'Date of Removal (or last evalulation)'),
+    ('line_days', 'Line Days (any catheter)'),
+    ('inpatient_line_days', 'Inpatient Line Days (any catheter)'),
+    ('outpatient_line_days', 'Outpatient Line Days (any catheter)'),
+    ('lumen_days', 'Lumen Days (Line Days x Number of Lumens)'),
+    ('inpatient_lumen_days', 'Inpatient Lumen Days (Line Days x Number of Lumens)'),
+    ('outpatient_lumen_days', 'Outpatient Lumen Days (Line Days x Number of Lumens)'),
+    ('inpatient_clabsis', 'Number of Inpatient CLABSIs'),
+    ('outpatient_clabsis', 'Number of Outpatient CLABSIs'),
+    ('clabsis', 'Total CLABSIs'),
+    ('inpatient_clancs', 'Number of Inpatient CLANCs'),
+    ('outpatient_clancs', 'Number of Outpatient CLANCs'),
+    ('clancs', 'Total CLANCs'),
+    ('clanc_to_removal', 'Time from CLANC to line removal (Days)'),
+    ('removal_reason', 'Reason For Line Removal'),
+    ('events', 'ALL EVENTS'),
+    ('event_rate', 'ALL EVENT RATE (x1000)'),
+    ('inpatient_clabsi_rate', 'Inpatient CLASBI Rate (x1000)'),
+    ('outpatient_clabsi_rate', 'Outpatient CLASBI Rate (x1000)'),
+    ('clabsi_rate', 'Total CLASBI Rate (x1000)'),
+    ('inpatient_clanc_rate', 'Inpatient CLANC Rate (x1000)'),
+    ('outpatient_clanc_rate', 'Outpatient CLANC Rate (x1000)'),
+    ('clanc_rate', 'Total CLANC Rate (x1000)'),
+]
+
+ATTRIBUTION_COLUMNS = [
+    ('patient_id', 'Patient ID'),
+    ('clabsi_date', 'CLABSI Date'),
+    ('line_id', 'Line ID'),
+    ('lines', 'Lines In Place'),
+    ('weight', 'CLABSI Credit'),
+    ('inpatient', 'Inpatient'),
+]
+
+STRATUM_COLUMNS = [
+    ('stratum', 'Stratified By'),
+    ('value', 'Value'),
+    ('lines', 'Lines'),
+    ('line_days', 'Line Days (any catheter)'),
+    ('inpatient_line_days', 'Inpatient Line Days (any catheter)'),
+    ('outpatient_line_days', 'Outpatient Line Days (any catheter)'),
+    ('lumen_days', 'Lumen Days (Line Days x Number of Lumens)'),
+    ('clabsis', 'Total CLABSIs'),
+    ('inpatient_clabsis', 'Number of Inpatient CLABSIs'),
+    ('outpatient_clabsis', 'Number of Outpatient CLABSIs'),
+    ('clancs', 'Total CLANCs'),
+    ('inpatient_clancs', 'Number of Inpatient CLANCs'),
+    ('outpatient_clancs', 'Number of Outpatient CLANCs'),
+    ('clabsi_rate', 'Total CLABSI Rate (x1000)'),
+    ('inpatient_clabsi_rate', 'Inpatient CLABSI Rate (x1000)'),
+    ('outpatient_clabsi_rate', 'Outpatient CLABSI Rate (x1000)'),
+    ('clanc_rate', 'Total CLANC Rate (x1000)'),
+    ('inpatient_clanc_rate', 'Inpatient CLANC Rate (x1000)'),
+    ('outpatient_clanc_rate', 'Outpatient CLANC Rate (x1000)'),
+    ('event_rate', 'ALL EVENT RATE (x1000)'),
+]
+
+TIME_SERIES_COLUMNS = [
+    ('date', 'Date'),
+    ('line_days', 'Line Days (any catheter)'),
+    ('lumen_days', 'Lumen Days (Line Days x Number of Lumens)'),
+    ('cath_days', 'Days with any Catheter'),
+    ('inpatient_cath_days', 'Inpatient Catheter Days'),
+    ('outpatient_cath_days', 'Outpatient Catheter Days'),
+    ('clabsis', 'CLABSIs'),
+    ('clancs', 'CLANCs'),
+    ('events', 'ALL EVENTS'),
+    ('clabsi_rate_30', '30 Day CLABSI Rate (x1000)'),
+    ('clanc_rate_30', '30 Day CLANC Rate (x1000)'),
+    ('event_rate_30', '30 Day ALL EVENT Rate (x1000)'),
+    ('clabsi_rate_90', '90 Day CLABSI Rate (x1000)'),
+    ('clanc_rate_90', '90 Day CLANC Rate (x1000)'),
+    ('event_rate_90', '90 Day ALL EVENT Rate (x1000)'),
+]
+
+ANOMALY_COLUMNS = [
+    ('check', 'Data Quality Check'),
+    ('patient_id', 'Patient ID'),
+    ('line_id', 'Line ID'),
+    ('date', 'Date'),
+    ('detail', 'Detail'),
+]
+
+ANOMALY_COUNT_COLUMNS = [
+    ('check', 'Data Quality Check'),
+    ('records', 'Flagged Records'),
+]
+
+#  Data quality checks made while the patient rows are built, in the order they are reported
+OVERLAPPING_VISITS = 'Overlapping visits'
+LINE_OUT_BEFORE_IN = 'Line removed before insertion'
+CLANC_OUTSIDE_LINE = 'CLANC outside line dwell'
+DUPLICATE_CLABSI = 'Duplicate CLABSI'
+ANOMALY_CHECKS = [OVERLAPPING_VISITS, LINE_OUT_BEFORE_IN, CLANC_OUTSIDE_LINE, DUPLICATE_CLABSI]
+
+#  Number formats of output table columns, by field name
+COLUMN_FORMATS = {
+    'in_date': 'dd-mmm-yy',
+    'out_date': 'dd-mmm-yy',
+    'clabsi_date': 'dd-mmm-yy',
+    'date': 'dd-mmm-yy',
+}
+
+#  Line attributes the line output is summarised by. Each entry is a tuple of Line attribute names.
+STRATA = [('line_type',), ('lumens',), ('removal_reason',), ('line_type', 'lumens')]
+
+#  One row of the patient, line and stratified output sheets, in column order.
+PatientRow = namedtuple('PatientRow', [name for name, _ in PATIENT_COLUMNS])
+LineRow = namedtuple('LineRow', [name for name, _ in LINE_COLUMNS])
+StratumRow = namedtuple('StratumRow', [name for name, _ in STRATUM_COLUMNS])
+TimeSeriesRow = namedtuple('TimeSeriesRow', [name for name, _ in TIME_SERIES_COLUMNS])
+AttributionRow = namedtuple('AttributionRow', [name for name, _ in ATTRIBUTION_COLUMNS])
+AnomalyRow = namedtuple('AnomalyRow', [name for name, _ in ANOMALY_COLUMNS])
+AnomalyCountRow = namedtuple('AnomalyCountRow', [name for name, _ in ANOMALY_COUNT_COLUMNS])
+
+
+class Results:
+    """In-memory result tables of an analysis.
+
+    Rows are PatientRow, LineRow, StratumRow, AttributionRow, TimeSeriesRow and AnomalyRow tuples.
+    """
+
+    def __init__(self, patients, patient_rows, line_rows, totals, stratum_rows=None, attribution_rows=None,
+                 time_series_rows=None, anomaly_rows=None):
+        self.patients = patients
+        self.patient_rows = patient_rows
+        self.line_rows = line_rows
+        self.totals = totals
+        self.stratum_rows = stratum_rows if stratum_rows is not None else []
+        self.attribution_rows = attribution_rows if attribution_rows is not None else []
+        self.time_series_rows = time_series_rows if time_series_rows is not None else []
+        self.anomaly_rows = anomaly_rows if anomaly_rows is not None else []
+
+    def anomaly_counts(self):
+        """Returns an AnomalyCountRow for each data quality check, including those with nothing flagged."""
+        counts = dict((check, 0) for check in ANOMALY_CHECKS)
+        for r in self.anomaly_rows:
+            counts[r.check] += 1
+        return [AnomalyCountRow(check, counts[check]) for check in ANOMALY_CHECKS]
+
+    def to_dataframes(self):
+        """Returns a dictionary of the result tables as pandas DataFrames. Requires pandas."""
+        import pandas
+        return {
+            'patient': pandas.DataFrame(self.patient_rows, columns=PatientRow._fields),
+            'line': pandas.DataFrame(self.line_rows, columns=LineRow._fields),
+            'stratified': pandas.DataFrame(self.stratum_rows, columns=StratumRow._fields),
+            'attribution': pandas.DataFrame(self.attribution_rows, columns=AttributionRow._fields),
+            'time_series': pandas.DataFrame(self.time_series_rows, columns=TimeSeriesRow._fields),
+            'anomalies': pandas.DataFrame(self.anomaly_rows, columns=AnomalyRow._fields),
+        }
+
+
+class Rules:
+    """Attribution rules: which visits count, when events are inpatient and which lines a CLABSI is credited to.
+
+    Windows are given in days (hours for the admission length) and compiled once into timedelta offsets
+    of the event date, so each rule is a pair of datetime comparisons per visit or line. The defaults are
+    the rules the calculator has always applied:
+
+    min_admit_hours: visits shorter than this are not counted as admissions.
+    clabsi_admit_days, clabsi_discharge_days: a CLABSI is inpatient from this many days after check in
+        until this many days after check out, inclusive.
+    clanc_admit_days, clanc_discharge_days: a CLANC is inpatient after this many days after check in, up to
+        and including this many days after check out.
+    line_insertion_days, line_removal_days: a CLABSI is credited to lines inserted at least this many days
+        before it, and removed no more than this many days before it.
+    """
+
+    #  Rule settings and their defaults, in the order they are described
+    SETTINGS = [
+        ('min_admit_hours', 24),
+        ('clabsi_admit_days', 2),
+        ('clabsi_discharge_days', 1),
+        ('clanc_admit_days', 0),
+        ('clanc_discharge_days', 0),
+        ('line_insertion_days', 0),
+        ('line_removal_days', 0),
+    ]
+
+    def __init__(self, name='Default', **settings):
+        unknown = [key for key in settings if key not in dict(self.SETTINGS)]
+        if unknown:
+            raise BadFormatException("Unknown attribution rule settings: " + ', '.join(sorted(unknown)))
+        self.name = name
+        self.settings = [(key, settings.get(key, default)) for key, default in self.SETTINGS]
+        for key, value in self.settings:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise BadFormatException("Attribution rule setting " + key + " must be a number.")
+        values = dict(self.settings)
+        self.min_admit = timedelta(hours=values['min_admit_hours'])
+        self.clabsi_admit = timedelta(days=values['clabsi_admit_days'])
+        self.clabsi_discharge = timedelta(days=values['clabsi_discharge_days'])
+        self.clanc_admit = timedelta(days=values['clanc_admit_days'])
+        self.clanc_discharge = timedelta(days=values['clanc_discharge_days'])
+        self.line_insertion = timedelta(days=values['line_insertion_days'])
+        self.line_removal = timedelta(days=values['line_removal_days'])
+
+    def full_day_admit(self, in_time, out_time):
+        """Returns True if a visit is long enough to count. Visits checked out before checking in are kept."""
+        return not timedelta(0) <= out_time - in_time < self.min_admit
+
+    def lines_in_place(self, lines, event_date):
+        """Returns the lines a CLABSI on event_date is credited to."""
+        inserted_by = event_date - self.line_insertion
+        removed_after = event_date - self.line_removal
+        return [l for l in lines if l.in_date <= inserted_by and l.out_date >= removed_after]
+
+    def clabsi_inpatient(self, visits, event_date):
+        """Returns True if a CLABSI on event_date falls in the inpatient window of any visit."""
+        admitted_by = event_date - self.clabsi_admit
+        discharged_after = event_date - self.clabsi_discharge
+        for v in visits:
+            if v.check_in_date <= admitted_by and v.check_out_date >= discharged_after:
+                return True
+        return False
+
+    def clanc_inpatient(self, visits, event_date):
+        """Returns True if a CLANC on event_date falls in the inpatient window of any visit."""
+        admitted_before = event_date - self.clanc_admit
+        discharged_after = event_date - self.clanc_discharge
+        for v in visits:
+            if v.check_in_date < admitted_before and v.check_out_date >= discharged_after:
+                return True
+        return False
+
+
+DEFAULT_RULES = Rules()
+
+
+def parse_date_range(start=None, end=None):
+    """Returns the start and end of a date range given as YYYY-MM-DD text, both days included.
+
+    A missing start or end leaves the range open on that side.
+    """
+    start_range = datetime.strptime(start, '%Y-%m-%d') if start else datetime.min
+    end_range = datetime.strptime(end + ' 23:59:59', '%Y-%m-%d %H:%M:%S') if end else datetime.max
+    return start_range, end_range
+
+
+def read_rules(path):
+    """Returns the Rules in a JSON file: an object of Rules settings, with an optional name."""
+    with open(path) as f:
+        settings = json.load(f)
+    if not isinstance(settings, dict):
+        raise BadFormatException("Attribution rules in " + path + " must be a JSON object.")
+    settings.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+    return Rules(**settings)
+
+
+def process_data(title, admit_path, line_path, clabsi_path, clanc_path, out_path, start_range, end_range,
+                 time_series=None, canonical=False, cohort=None, rules=DEFAULT_RULES):
+    """Read in each file and writes results to the out_path.
+
+    time_series is the number of days per row of an additional time series output (1 for daily, 7 for weekly).
+    canonical orders the output by Patient ID and line insertion date instead of input order. A line with
+    several CLANCs then reports its latest CLANC by date, rather than the last one in the CLANC file.
+    cohort is a collection of Patient IDs, or the path of a file of them, to restrict the analysis to.
+    rules are the attribution Rules, or the path of a rules file (see read_rules).
+    """
     # try:
     #     end_range += timedelta(days=1)
     # except Exception:
     #     pass
 
-    events = {}
-    print("processing...0/6")
-    patients = read_line_data(line_path, start_range, end_range)
-    print("processing...1/6")
-    read_patient_data(admit_path, patients, start_range, end_range)
-    print("processing...2/6")
-    read_clabsi_data(clabsi_path, patients, start_range, end_range)
-    print("processing...3/6")
-    read_clanc_data(clanc_path, patients, start_range, end_range)
-    print("processing...4/6")
-    generate_patient_output(title, out_path, patients, events, start_range, end_range)
+    results = analyze_data(admit_path, line_path, clabsi_path, clanc_path, start_range, end_range,
+                           progress=True, time_series=time_series, canonical=canonical, cohort=cohort,
+                           rules=rules)
+    write_patient_output(title, out_path, results)
     print("processing...5/6")
-    generate_line_output(title, out_path, patients, events)
+    write_line_output(title, out_path, results)
+    if time_series:
+        write_time_series_output(title, out_path, results)
     print("complete...6/6")
     return True
 
 
-def read_line_data(path, start_range, end_range):
-    """Read in line data. Stores lines as Line objects associated with Patient IDs."""
+def analyze_data(admit, line, clabsi, clanc, start_range=datetime.min, end_range=datetime.max, progress=False,
+                 strata=STRATA, time_series=None, canonical=False, cohort=None, rules=DEFAULT_RULES):
+    """Reads the input data and returns a Results object. Does not write any files.
+
+    Each input may be an Excel file path or an iterable of data rows (without the title row).
+    strata lists the tuples of Line attributes the line metrics are also summarised by.
+    time_series is the number of days per time series row, or None to skip the time series.
+    canonical orders patients, lines and events with canonical_order() so the results do not depend on
+    the row order of the inputs. A line with several CLANCs then reports its latest CLANC by date;
+    otherwise it reports the last of them in the CLANC input.
+    cohort is a collection of Patient IDs, or the path of a file of them (see read_cohort). Rows of other
+    patients are skipped as they are read.
+    rules are the attribution Rules, or the path of a rules file (see read_rules).
+    """
+    if isinstance(rules, str):
+        rules = read_rules(rules)
+    if isinstance(cohort, str):
+        cohort = read_cohort(cohort)
+    elif cohort is not None:
+        cohort = set(cohort)
+    if progress:
+        print("processing...0/6")
+    patients = read_line_data(line, start_range, end_range, cohort)
+    if progress:
+        print("processing...1/6")
+    read_patient_data(admit, patients, start_range, end_range, cohort, rules)
+    if progress:
+        print("processing...2/6")
+    read_clabsi_data(clabsi, patients, start_range, end_range, cohort, rules)
+    if progress:
+        print("processing...3/6")
+    read_clanc_data(clanc, patients, start_range, end_range, cohort, rules)
+    if progress:
+        print("processing...4/6")
+    return analyze_patients(patients, start_range, end_range, strata, time_series, canonical)
+
+
+def analyze_patients(patients, start_range, end_range, strata=STRATA, time_series=None, canonical=False):
+    """Returns a Results object for a dictionary of Patients that already hold their lines, visits and events.
+
+    The options are those of analyze_data.
+    """
+    if canonical:
+        patients = canonical_order(patients)
+    census = DailyCensus() if time_series else None
+    anomalies = []
+    patient_rows, totals = build_patient_rows(patients, start_range, end_range, census, anomalies)
+    summary = StratifiedSummary(strata)
+    line_rows = build_line_rows(patients, summary)
+    return Results(patients, patient_rows, line_rows, totals, summary.rows(), build_attribution_rows(patients),
+                   census.rows(time_series) if census else None, anomalies)
+
+
+def iter_excel_rows(path):
+    """Yields the data rows (below the title row) of the active sheet of an Excel file as tuples."""
     work_book = load_workbook(path, read_only=True)
-    w_sheet = work_book.active
-    patients = {}
-    index = 2
-    while index <= w_sheet.max_row and w_sheet['A' + str(index)].value is not None:
-        p_id = w_sheet['A' + str(index)].value
-        line_id = w_sheet['B' + str(index)].value
-        line_type = w_sheet['C' + str(index)].value
-        lumens = w_sheet['D' + str(index)].value
-        in_date = w_sheet['E' + str(index)].value
-        out_date = w_sheet['F' + str(index)].value
+    return work_book.active.iter_rows(min_row=2, values_only=True)
+
+
+def load_rows(path):
+    """Returns the data rows of an Excel file as a list, so they can be read more than once."""
+    return list(iter_excel_rows(path))
+
+
+def read_rows(source, width, cohort=None):
+    """Yields the data rows of an Excel file path or row iterable as lists of width values.
+
+    When a cohort set is given, rows whose Patient ID (first value) is not in it are skipped. Rows
+    without a Patient ID are still yielded.
+    """
+    rows = iter_excel_rows(source) if isinstance(source, str) else source
+    for row in rows:
+        if cohort is not None and row and row[0] is not None and row[0] not in cohort:
+            continue
+        row = list(row[:width])
+        if len(row) < width:
+            row += [None] * (width - len(row))
+        yield row
+
+
+def read_cohort(path):
+    """Returns the set of Patient IDs in column A of an Excel file, or one per line of a text file."""
+    try:
+        if os.path.splitext(path)[1].lower() in ('.xlsx', '.xls'):
+            return set(row[0] for row in iter_excel_rows(path) if row and row[0] is not None)
+        cohort = set()
+        with open(path) as f:
+            for text in f:
+                text = text.strip()
+                if text:
+                    cohort.add(int(text) if text.isdigit() else text)
+        return cohort
+    except Exception as e:
+        raise BadFormatException("Could not read the cohort file " + path + ": " + str(e))
+
+
+def line_data_rows(source, cohort=None):
+    """Yields validated line data rows: Patient ID, Line ID, line type, lumens, in date, out date, removal reason.
+
+    Reading stops at the first row without a Patient ID.
+    """
+    for p_id, line_id, line_type, lumens, in_date, out_date, last_date, removal_reason in read_rows(source, 8, cohort):
+        if p_id is None:
+            break
         if out_date is None:
-            out_date = w_sheet['G' + str(index)].value
-        removal_reason = w_sheet['H' + str(index)].value
+            out_date = last_date
 
         #  Spreadsheet format check
         #  if not isinstance(p_id, int):
@@ -127,10 +517,15 @@ def read_line_data(path, start_range, end_range):
             raise BadFormatException("Patient Disscharge Dates in Column F and G of Patient Data must be dates.")
         if not isinstance(removal_reason, str) and removal_reason is not None:
             raise BadFormatException("Reason For Removal in Column H of Line Data must be text.")
+        yield p_id, line_id, line_type, lumens, in_date, out_date, removal_reason
 
+
+def read_line_data(source, start_range, end_range, cohort=None):
+    """Read in line data. Stores lines as Line objects associated with Patient IDs."""
+    patients = {}
+    for p_id, line_id, line_type, lumens, in_date, out_date, removal_reason in line_data_rows(source, cohort):
         # Check Dates
         if (in_date < start_range and out_date < start_range) or (in_date > end_range):
-            index += 1
             continue  # Do not add dates outside of range
         # commented out because i think it confuses the end result.
         #  elif in_date < start_range and out_date > start_range:
@@ -144,20 +539,12 @@ def read_line_data(path, start_range, end_range):
 
         l = Line(line_id, line_type, lumens, in_date, out_date, removal_reason, start_range, end_range)
         patients[p_id].add_line(l)
-        index += 1
     return patients
 
 
-def read_patient_data(path, patients, start_range, end_range):
-    """Read in patient admit data. Returns a dictionary of Patient objects (Key: ID Number)."""
-    work_book = load_workbook(path, read_only=True)
-    w_sheet = work_book.active
-    index = 2
-    while index <= w_sheet.max_row:
-        p_id = w_sheet['A' + str(index)].value
-        in_date = w_sheet['B' + str(index)].value
-        out_date = w_sheet['C' + str(index)].value
-
+def admit_data_rows(source, cohort=None):
+    """Yields validated patient admission rows: Patient ID, check in date, check out date."""
+    for p_id, in_date, out_date in read_rows(source, 3, cohort):
         #  Spreadsheet format check
         if not isinstance(p_id, int):
             raise BadFormatException("Patient ID Numbers in Column A of Patient Data must be numbers.")
@@ -165,149 +552,144 @@ def read_patient_data(path, patients, start_range, end_range):
             raise BadFormatException("Patient Admission Dates in Column B of Patient Data must be dates.")
         if not isinstance(in_date, datetime):
             raise BadFormatException("Patient Disscharge Dates in Column C of Patient Data must be dates.")
+        yield p_id, in_date, out_date
+
 
+def read_patient_data(source, patients, start_range, end_range, cohort=None, rules=DEFAULT_RULES):
+    """Read in patient admit data. Returns a dictionary of Patient objects (Key: ID Number)."""
+    for p_id, in_date, out_date in admit_data_rows(source, cohort):
         if out_date < start_range or in_date > end_range:
-            index += 1
             continue
 
-        if p_id in patients and check_full_day_admit(in_date, out_date):
+        if p_id in patients and rules.full_day_admit(in_date, out_date):
             patients[p_id].add_visit(Visit(patients[p_id], in_date, out_date))
 
-        index += 1
-
-
-def read_clabsi_data(path, patients, start_range, end_range):
-    work_book = load_workbook(path, read_only=True)
-    w_sheet = work_book.active
-    index = 2
-    while index <= w_sheet.max_row:
-        p_id = w_sheet['A' + str(index)].value
-        clabsi_date = w_sheet['B' + str(index)].value
 
+def clabsi_data_rows(source, cohort=None):
+    """Yields validated CLABSI rows: Patient ID, CLABSI date."""
+    for p_id, clabsi_date in read_rows(source, 2, cohort):
         if not isinstance(p_id, int):
             raise BadFormatException("Patient ID Numbers in Column A of CLABSI Data must be numbers.")
         if not isinstance(clabsi_date, datetime):
             raise BadFormatException("CLABSI Date in Column B of CLABSI Data must be a date.")
+        yield p_id, clabsi_date
 
+
+def read_clabsi_data(source, patients, start_range, end_range, cohort=None, rules=DEFAULT_RULES):
+    for p_id, clabsi_date in clabsi_data_rows(source, cohort):
         if clabsi_date < start_range or clabsi_date > end_range:
-            index += 1
             continue
 
         if p_id in patients:
-            p = patients[p_id]
-            lines = []
-            for l in p.lines:
-                if l.in_date <= clabsi_date and l.out_date >= clabsi_date:
-                    lines.append(l)
-
-            event = CLABSI(p, lines, clabsi_date)
-
-            for visit in p.visits:
-                if visit.check_in_date + timedelta(days=2) <= clabsi_date <= visit.check_out_date + timedelta(days=1):
-                    event.inpatient = True
-                    break
-            else:
-                event.inpatient = False
+            add_clabsi(patients[p_id], clabsi_date, rules)
 
-            p.clabsis.append(event)
-
-        index += 1
 
+def add_clabsi(p, clabsi_date, rules=DEFAULT_RULES):
+    """Adds a CLABSI to a Patient, attributed to every line in place on its date. Returns the CLABSI."""
+    lines = rules.lines_in_place(p.lines, clabsi_date)
+    event = CLABSI(p, lines, clabsi_date)
+    for l in lines:
+        l.clabsis.append(event)
+    event.inpatient = rules.clabsi_inpatient(p.visits, clabsi_date)
+    p.clabsis.append(event)
+    return event
 
-def read_clanc_data(path, patients, start_range, end_range):
-    work_book = load_workbook(path, read_only=True)
-    w_sheet = work_book.active
-    index = 2
-    while index <= w_sheet.max_row:
-        p_id = w_sheet['A' + str(index)].value
-        line_id = w_sheet['B' + str(index)].value
-        clanc_date = w_sheet['C' + str(index)].value
 
+def clanc_data_rows(source, cohort=None):
+    """Yields validated CLANC rows: Patient ID, Line ID, CLANC date."""
+    for p_id, line_id, clanc_date in read_rows(source, 3, cohort):
         if not isinstance(p_id, int):
             raise BadFormatException("Patient ID Numbers in Column A of CLANC Data must be numbers.")
         if not isinstance(line_id, int):
             raise BadFormatException("Line ID Numbers in Column B of CLANC Data must be numbers.")
         if not isinstance(clanc_date, datetime):
             raise BadFormatException("CLABSI Date in Column C of CLANC Data must be a date.")
+        yield p_id, line_id, clanc_date
+
 
+def read_clanc_data(source, patients, start_range, end_range, cohort=None, rules=DEFAULT_RULES):
+    for p_id, line_id, clanc_date in clanc_data_rows(source, cohort):
         if clanc_date < start_range or clanc_date > end_range:
-            index += 1
             continue
 
         if p_id in patients:
-            p = patients[p_id]
-            line = [l for l in p.lines if line_id == l.line_id]
-            if line:
-                line = line[0]
-            else:
-                index += 1
-                continue
-            event = CLANC(p, line, clanc_date)
-            for visit in p.visits:
-                if visit.check_in_date < clanc_date <= visit.check_out_date:
-                    event.inpatient = True
-                    break
-            else:
-                event.inpatient = False
+            add_clanc(patients[p_id], line_id, clanc_date, rules)
 
-            p.clancs.append(event)
-            line.clanc = event
-        index += 1
 
+def add_clanc(p, line_id, clanc_date, rules=DEFAULT_RULES):
+    """Adds a CLANC to a Patient's line. Returns the CLANC, or None if the Patient has no line line_id."""
+    line = [l for l in p.lines if line_id == l.line_id]
+    if line:
+        line = line[0]
+    else:
+        return None
+    event = CLANC(p, line, clanc_date)
+    event.inpatient = rules.clanc_inpatient(p.visits, clanc_date)
 
-def check_full_day_admit(in_time, out_time):
-    """Returns True if Patient was admitted for at least 24 hours."""
-    diff = out_time - in_time
-    if diff.days == 0:
-        return False
-    return True
+    p.clancs.append(event)
+    line.clanc = event
+    return event
 
 
-def generate_patient_output(title, path, patients, events, start_range, end_range):
-    """Writes patient-only analysis to new Excel file."""
-    work_book = Workbook()
-    w_sheet = work_book.active
+def patient_sort_key(p_id):
+    """Sort key for Patient IDs. Numeric IDs sort before text IDs."""
+    return (isinstance(p_id, str), p_id)
 
-    #  Column Titles
-    w_sheet.title = 'Output Individual Patient'
-    w_sheet['A1'] = 'Patient ID'
-    w_sheet['B1'] = 'Total Lines'
-    w_sheet['C1'] = 'Sum of all Line Days'
-    w_sheet['D1'] = 'Inpatient Line Days'
-    w_sheet['E1'] = 'Outpatient Line Days'
-    w_sheet['F1'] = 'Mean Duration of Line (Days)'
-    w_sheet['G1'] = 'Total Days with any Catheter'
-    w_sheet['H1'] = 'Catheter Density (Sum of all Line Days/Total Days with any catheter)'
-    w_sheet['I1'] = 'Sum of all Lumen Days'
-    w_sheet['J1'] = 'Inpatient Lumen Days'
-    w_sheet['K1'] = 'Outpatient Lumen Days'
-    w_sheet['L1'] = 'Inpatient Lumen Density (Inpatient Lumen Days/Total Inpatient Days With A Catheter)'
-    w_sheet['M1'] = 'Outpatient Lumen Density (Outpatient Lumen Days/Total Outpatient Days With A Catheter)'
-    w_sheet['N1'] = 'Total Lumen Density (Sum of all Lumen Days/Total Days with any catheter)'
-    w_sheet['O1'] = 'CLABSIs'
-    w_sheet['P1'] = 'Inpatient CLABSIs'
-    w_sheet['Q1'] = 'Outpatient CLABSIs'
-    w_sheet['R1'] = 'Inpatient CLABSI Rate (x1000)'
-    w_sheet['S1'] = 'Outpatient CLABSI Rate (x1000)'
-    w_sheet['T1'] = "CLABSI Rate (x1000)"
-    w_sheet['U1'] = 'CLANCs'
-    w_sheet['V1'] = 'Inpatient CLANCs'
-    w_sheet['W1'] = 'Outpatient CLANCs'
-    w_sheet['X1'] = "Inpatient CLANC Rate (x1000)"
-    w_sheet['Y1'] = "Outpatient CLANC Rate (x1000)"
-    w_sheet['Z1'] = "CLANC Rate (x1000)"
-    w_sheet['AA1'] = "ALL EVENT Rate (x1000)"
-    w_sheet['AB1'] = "Inpatient Catheter Days"
-    w_sheet['AC1'] = "Outpatient Catheter Days"
-    w_sheet['AD1'] = "Inpatient Line Density"
-    w_sheet['AE1'] = "Outpatient Line Density"
-
-    pop_inp = 0
-    pop_out = 0
-
-    row = 2
+
+def line_sort_key(l):
+    """Sort key for Lines: insertion date, then removal date, then Line ID."""
+    return (l.in_date, l.out_date, l.line_id)
+
+
+def canonical_order(patients):
+    """Returns the patients dictionary ordered by Patient ID, with each Patient's lines, visits and events sorted.
+
+    Lines sort by line_sort_key, visits by check in date and events by date, so results do not depend
+    on the row order of the input data. Each line's reported CLANC (Line.clanc) becomes its latest CLANC
+    by date, where without canonical ordering it is the last one read.
+    """
+    ordered = {}
+    for p_id in sorted(patients, key=patient_sort_key):
+        p = patients[p_id]
+        p.lines.sort(key=line_sort_key)
+        p.visits.sort(key=lambda v: (v.check_in_date, v.check_out_date))
+        p.clabsis.sort(key=lambda e: e.date)
+        p.clancs.sort(key=lambda e: (e.date, e.line.line_id))
+        for e in p.clancs:
+            e.line.clanc = e  # the latest CLANC of a line is reported, whatever the input order
+        for l in p.lines:
+            l.clabsis.sort(key=lambda e: e.date)
+        for e in p.clabsis:
+            e.lines.sort(key=line_sort_key)
+        ordered[p_id] = p
+    return ordered
+
+
+def check_full_day_admit(in_time, out_time, rules=DEFAULT_RULES):
+    """Returns True if Patient was admitted for at least 24 hours (min_admit_hours of the rules)."""
+    return rules.full_day_admit(in_time, out_time)
+
+
+def ratio(numerator, denominator, scale=None):
+    """Returns numerator / denominator (times scale), or 0 when the denominator is 0."""
+    if not denominator:
+        return 0
+    if scale is None:
+        return numerator / denominator
+    return numerator / denominator * scale
+
+
+def build_patient_rows(patients, start_range, end_range, census=None, anomalies=None):
+    """Calculates patient-only analysis. Returns a list of PatientRows and the population total PatientRow.
+
+    Each patient's catheter days, lines and events are also added to census, a DailyCensus, when one is given.
+    The AnomalyRows of each patient's data quality checks are appended to anomalies, when a list is given.
+    """
+    rows = []
     for p_id in patients:
         p = patients[p_id]
+        if anomalies is not None:
+            anomalies += find_anomalies(p_id, p)
         calculate_inpatient_line_days(p, start_range, end_range)
         for l in p.lines:
             p.inpatient_lumen_time += l.inpatient_lumen_time
@@ -327,55 +709,374 @@ def generate_patient_output(title, path, patients, events, start_range, end_rang
             else:
                 out_clanc += 1
 
-        total_cath_days, inp_cath_days, outp_cath_days = calculate_total_cath_days(p, start_range,
-                                                                                   end_range) if p.lines else 0
-        pop_inp += inp_cath_days
-        pop_out += outp_cath_days
-
-        w_sheet['A' + str(row)] = p_id
-        w_sheet['B' + str(row)] = len(p.lines)
-        w_sheet['C' + str(row)] = p.total_line_time.days
-        w_sheet['D' + str(row)] = p.inpatient_line_time
-        w_sheet['E' + str(row)] = p.total_line_time.days - p.inpatient_line_time
-        w_sheet['F' + str(row)] = (p.total_line_time.days / len(p.lines)) if p.lines else 0
-        w_sheet['G' + str(row)] = total_cath_days
-        w_sheet['H' + str(row)] = (w_sheet['C' + str(row)].value / w_sheet['G' + str(row)].value) if w_sheet['G' + str(
-            row)].value != 0 else 0
-        w_sheet['I' + str(row)] = p.total_lumen_time.days  # check
-        w_sheet['J' + str(row)] = p.inpatient_lumen_time
-        w_sheet['K' + str(row)] = p.total_lumen_time.days - p.inpatient_lumen_time
-        w_sheet['L' + str(row)] = (w_sheet['J' + str(row)].value / inp_cath_days) if inp_cath_days else 0
-        w_sheet['M' + str(row)] = (w_sheet['K' + str(row)].value / outp_cath_days) if outp_cath_days else 0
-        w_sheet['N' + str(row)] = (w_sheet['I' + str(row)].value / w_sheet['G' + str(row)].value) if w_sheet['G' + str(
-            row)].value != 0 else 0
-        w_sheet['O' + str(row)] = len(p.clabsis)
-        w_sheet['P' + str(row)] = in_clabsi
-        w_sheet['Q' + str(row)] = out_clabsi
-        w_sheet['R' + str(row)] = ((in_clabsi / inp_cath_days) * 1000) if inp_cath_days else 0
-        w_sheet['S' + str(row)] = ((out_clabsi / outp_cath_days) * 1000) if outp_cath_days else 0
-        w_sheet['T' + str(row)] = (w_sheet['O' + str(row)].value / w_sheet['G' + str(row)].value * 1000) if w_sheet[
-                                                                                                                'G' + str(
-                                                                                                                    row)].value != 0 else 0
-        w_sheet['U' + str(row)] = len(p.clancs)
-        w_sheet['V' + str(row)] = in_clanc
-        w_sheet['W' + str(row)] = out_clanc
-        w_sheet['X' + str(row)] = ((in_clanc / inp_cath_days) * 1000) if inp_cath_days else 0
-        w_sheet['Y' + str(row)] = ((out_clanc / outp_cath_days) * 1000) if outp_cath_days else 0
-        w_sheet['Z' + str(row)] = (w_sheet['U' + str(row)].value / w_sheet['G' + str(row)].value * 1000) if w_sheet[
-                                                                                                                'G' + str(
-                                                                                                                    row)].value != 0 else 0
-        w_sheet['AA' + str(row)] = (
-        (in_clanc + out_clanc + in_clabsi + out_clabsi) / w_sheet['G' + str(row)].value * 1000) if w_sheet['G' + str(
-            row)].value != 0 else 0
-        w_sheet['AB' + str(row)] = inp_cath_days
-        w_sheet['AC' + str(row)] = outp_cath_days
-        w_sheet['AD' + str(row)] = p.inpatient_line_time / inp_cath_days if inp_cath_days else 0
-        w_sheet['AE' + str(row)] = (
-                                   p.total_line_time.days - p.inpatient_line_time) / outp_cath_days if outp_cath_days else 0
-
-        row += 1
-
-        # Summation Data
+        cath_days, inpatient_cath_days = calculate_cath_day_sets(p, start_range, end_range)
+        if census is not None:
+            census.add_patient(p, cath_days, inpatient_cath_days)
+        total_cath_days = len(cath_days)
+        inp_cath_days = len(inpatient_cath_days)
+        outp_cath_days = total_cath_days - inp_cath_days
+        line_days = p.total_line_time.days
+        outpatient_line_days = line_days - p.inpatient_line_time
+        lumen_days = p.total_lumen_time.days
+        outpatient_lumen_days = lumen_days - p.inpatient_lumen_time
+
+        rows.append(PatientRow(
+            patient_id=p_id,
+            total_lines=len(p.lines),
+            line_days=line_days,
+            inpatient_line_days=p.inpatient_line_time,
+            outpatient_line_days=outpatient_line_days,
+            mean_line_duration=ratio(line_days, len(p.lines)),
+            cath_days=total_cath_days,
+            cath_density=ratio(line_days, total_cath_days),
+            lumen_days=lumen_days,  # check
+            inpatient_lumen_days=p.inpatient_lumen_time,
+            outpatient_lumen_days=outpatient_lumen_days,
+            inpatient_lumen_density=ratio(p.inpatient_lumen_time, inp_cath_days),
+            outpatient_lumen_density=ratio(outpatient_lumen_days, outp_cath_days),
+            lumen_density=ratio(lumen_days, total_cath_days),
+            clabsis=len(p.clabsis),
+            inpatient_clabsis=in_clabsi,
+            outpatient_clabsis=out_clabsi,
+            inpatient_clabsi_rate=ratio(in_clabsi, inp_cath_days, 1000),
+            outpatient_clabsi_rate=ratio(out_clabsi, outp_cath_days, 1000),
+            clabsi_rate=ratio(len(p.clabsis), total_cath_days, 1000),
+            clancs=len(p.clancs),
+            inpatient_clancs=in_clanc,
+            outpatient_clancs=out_clanc,
+            inpatient_clanc_rate=ratio(in_clanc, inp_cath_days, 1000),
+            outpatient_clanc_rate=ratio(out_clanc, outp_cath_days, 1000),
+            clanc_rate=ratio(len(p.clancs), total_cath_days, 1000),
+            event_rate=ratio(in_clanc + out_clanc + in_clabsi + out_clabsi, total_cath_days, 1000),
+            inpatient_cath_days=inp_cath_days,
+            outpatient_cath_days=outp_cath_days,
+            inpatient_line_density=ratio(p.inpatient_line_time, inp_cath_days),
+            outpatient_line_density=ratio(outpatient_line_days, outp_cath_days),
+        ))
+    return rows, population_totals(rows)
+
+
+def find_anomalies(p_id, p):
+    """Returns an AnomalyRow for each record of a Patient that fails a data quality check.
+
+    Overlapping visits are double counted by calculate_inpatient_line_days, lines removed before insertion
+    have negative line days, and duplicate CLABSIs are each counted as events.
+    """
+    rows = []
+    latest = None
+    for v in sorted(p.visits, key=lambda v: (v.check_in_date, v.check_out_date)):
+        if latest is not None and v.check_in_date < latest.check_out_date:
+            rows.append(AnomalyRow(OVERLAPPING_VISITS, p_id, None, v.check_in_date,
+                                   'Admitted {:%Y-%m-%d %H:%M} during the visit of {:%Y-%m-%d %H:%M} to '
+                                   '{:%Y-%m-%d %H:%M}'.format(v.check_in_date, latest.check_in_date,
+                                                               latest.check_out_date)))
+        if latest is None or v.check_out_date > latest.check_out_date:
+            latest = v
+
+    for l in p.lines:
+        if l.out_date < l.in_date:
+            rows.append(AnomalyRow(LINE_OUT_BEFORE_IN, p_id, l.line_id, l.in_date,
+                                   'Removed {:%Y-%m-%d %H:%M}'.format(l.out_date)))
+
+    for e in p.clancs:
+        if not e.line.in_date <= e.date <= e.line.out_date:
+            rows.append(AnomalyRow(CLANC_OUTSIDE_LINE, p_id, e.line.line_id, e.date,
+                                   'Line in place {:%Y-%m-%d %H:%M} to {:%Y-%m-%d %H:%M}'.format(
+                                       e.line.in_date, e.line.out_date)))
+
+    dates = sorted(e.date for e in p.clabsis)
+    for clabsi_date, repeats in itertools.groupby(dates):
+        count = len(list(repeats))
+        if count > 1:
+            rows.append(AnomalyRow(DUPLICATE_CLABSI, p_id, None, clabsi_date,
+                                   'Reported {} times'.format(count)))
+    return rows
+
+
+def population_totals(rows):
+    """Returns a PatientRow of population totals matching the summation row of the patient output."""
+    sums = {}
+    for name in ('total_lines', 'line_days', 'inpatient_line_days', 'outpatient_line_days', 'cath_days',
+                 'lumen_days', 'inpatient_lumen_days', 'outpatient_lumen_days', 'clabsis', 'inpatient_clabsis',
+                 'outpatient_clabsis', 'clancs', 'inpatient_clancs', 'outpatient_clancs', 'inpatient_cath_days',
+                 'outpatient_cath_days'):
+        sums[name] = sum(getattr(r, name) for r in rows)
+    pop_inp = sums['inpatient_cath_days']
+    pop_out = sums['outpatient_cath_days']
+    return PatientRow(
+        patient_id='Population Total',
+        mean_line_duration=ratio(sums['line_days'], sums['total_lines']),
+        cath_density=ratio(sums['line_days'], sums['cath_days']),
+        inpatient_lumen_density=ratio(sums['inpatient_lumen_days'], pop_inp),
+        outpatient_lumen_density=ratio(sums['outpatient_lumen_days'], pop_out),
+        lumen_density=ratio(sums['lumen_days'], sums['cath_days']),
+        inpatient_clabsi_rate=ratio(sums['inpatient_clabsis'], pop_inp, 1000),
+        outpatient_clabsi_rate=ratio(sums['outpatient_clabsis'], pop_out, 1000),
+        clabsi_rate=ratio(sums['clabsis'], sums['cath_days'], 1000),
+        inpatient_clanc_rate=ratio(sums['inpatient_clancs'], pop_inp, 1000),
+        outpatient_clanc_rate=ratio(sums['outpatient_clancs'], pop_out, 1000),
+        clanc_rate=ratio(sums['clancs'], sums['cath_days'], 1000),
+        event_rate=ratio(sums['clabsis'] + sums['clancs'], sums['cath_days'], 1000),
+        inpatient_line_density=ratio(sums['inpatient_line_days'], pop_inp),
+        outpatient_line_density=ratio(sums['outpatient_line_days'], pop_out),
+        **sums)
+
+
+def build_line_rows(patients, summary=None):
+    """Calculates line-only analysis. Returns a list of LineRows.
+
+    Requires the inpatient line days calculated by build_patient_rows. Each row is also added to
+    summary, a StratifiedSummary, when one is given.
+    """
+    rows = []
+    for p_id in patients:
+        for l in patients[p_id].lines:
+            row = line_row(p_id, l)
+            rows.append(row)
+            if summary is not None:
+                summary.add(l, row)
+    return rows
+
+
+def line_row(p_id, l):
+    """Returns the LineRow of a Line, calculating each derived value once."""
+    num_inpatient = 0
+    num_outpatient = 0
+    for e in l.clabsis:
+        if e.inpatient:
+            num_inpatient += e.weight
+        else:
+            num_outpatient += e.weight
+    num_clabsis = num_inpatient + num_outpatient
+
+    num_in_clancs = 0
+    num_out_clancs = 0
+    if l.clanc:
+        if l.clanc.inpatient:
+            num_in_clancs = 1
+        else:
+            num_out_clancs = 1
+        diff = datetime.date(l.out_date) - datetime.date(l.clanc.date)
+        clanc_to_removal = diff.days
+    else:
+        clanc_to_removal = "No CLANC Reported"
+    num_clancs = num_in_clancs + num_out_clancs
+
+    line_days = l.total_time.days
+    inpatient_days = l.inpatient_line_time
+    outpatient_days = line_days - inpatient_days
+    lumen_days = l.lumen_days.days
+    total_events = num_in_clancs + num_out_clancs + num_inpatient + num_outpatient
+
+    # positional, in LINE_COLUMNS order
+    return LineRow(
+        l.line_id, p_id, l.lumens, l.in_date, l.out_date,
+        line_days, inpatient_days, outpatient_days,
+        lumen_days, l.inpatient_lumen_time, lumen_days - l.inpatient_lumen_time,
+        num_inpatient, num_outpatient, num_clabsis,
+        num_in_clancs, num_out_clancs, num_clancs,
+        clanc_to_removal, l.removal_reason,
+        total_events, ratio(total_events, line_days, 1000),
+        # clasbi in/out rate
+        ratio(num_inpatient, inpatient_days, 1000),
+        ratio(num_outpatient, outpatient_days, 1000),
+        ratio(num_clabsis, line_days, 1000),
+        # clanc in/out rate
+        ratio(num_in_clancs, inpatient_days, 1000),
+        ratio(num_out_clancs, outpatient_days, 1000),
+        ratio(num_clancs, line_days, 1000),
+    )
+
+
+def build_attribution_rows(patients):
+    """Returns an AttributionRow for each CLABSI and line it is credited to, for auditing.
+
+    CLABSIs with no line in place are listed once with no Line ID and no credit.
+    """
+    rows = []
+    for p_id in patients:
+        for e in patients[p_id].clabsis:
+            if not e.lines:
+                rows.append(AttributionRow(p_id, e.date, None, 0, 0, e.inpatient))
+            for l in e.lines:
+                rows.append(AttributionRow(p_id, e.date, l.line_id, len(e.lines), e.weight, e.inpatient))
+    return rows
+
+
+class DailyCensus:
+    """Accumulates the population's daily catheter census and events while the patient rows are built.
+
+    Day counts are kept as difference arrays over date ordinals, so each line or run of catheter days
+    costs two updates however long it is.
+    """
+
+    #  Daily counts kept as difference arrays
+    MEASURES = ('line_days', 'lumen_days', 'cath_days', 'inpatient_cath_days')
+
+    def __init__(self):
+        self.deltas = dict((m, {}) for m in self.MEASURES)
+        self.clabsis = {}
+        self.clancs = {}
+
+    def add_span(self, measure, first, last, amount=1):
+        """Adds amount to measure on each date ordinal from first up to, but not including, last."""
+        if first >= last:
+            return
+        deltas = self.deltas[measure]
+        deltas[first] = deltas.get(first, 0) + amount
+        deltas[last] = deltas.get(last, 0) - amount
+
+    def add_days(self, measure, days):
+        """Adds 1 to measure on each date of a set, as one span per run of consecutive dates."""
+        ordinals = sorted(d.toordinal() for d in days)
+        if not ordinals:
+            return
+        first = previous = ordinals[0]
+        for o in ordinals[1:]:
+            if o != previous + 1:
+                self.add_span(measure, first, previous + 1)
+                first = o
+            previous = o
+        self.add_span(measure, first, previous + 1)
+
+    def add_patient(self, p, cath_days, inpatient_cath_days):
+        """Adds a Patient's lines, events and sets of catheter days to the census."""
+        for l in p.lines:
+            first = l.in_date.toordinal()
+            last = l.out_date.toordinal()
+            self.add_span('line_days', first, last)
+            self.add_span('lumen_days', first, last, l.lumens)
+        self.add_days('cath_days', cath_days)
+        self.add_days('inpatient_cath_days', inpatient_cath_days)
+        for e in p.clabsis:
+            o = e.date.toordinal()
+            self.clabsis[o] = self.clabsis.get(o, 0) + 1
+        for e in p.clancs:
+            o = e.date.toordinal()
+            self.clancs[o] = self.clancs.get(o, 0) + 1
+
+    def rows(self, period=1):
+        """Returns a TimeSeriesRow for every period days, with rolling rates as of each period's last day."""
+        ends = [max(d) - 1 for d in self.deltas.values() if d] + [max(e) for e in (self.clabsis, self.clancs) if e]
+        starts = [min(d) for d in self.deltas.values() if d] + [min(e) for e in (self.clabsis, self.clancs) if e]
+        if not ends:
+            return []
+        first = min(starts)
+        size = max(ends) - first + 1
+
+        daily = {}
+        for measure, deltas in self.deltas.items():
+            diff = [0] * (size + 1)
+            for o, amount in deltas.items():
+                diff[o - first] += amount
+            daily[measure] = list(itertools.accumulate(diff[:size]))
+        for name, counts in (('clabsis', self.clabsis), ('clancs', self.clancs)):
+            daily[name] = [0] * size
+            for o, count in counts.items():
+                daily[name][o - first] = count
+
+        prefix = {}
+        for name in ('cath_days', 'clabsis', 'clancs'):
+            prefix[name] = [0] + list(itertools.accumulate(daily[name]))
+
+        def window(name, day, days):
+            return prefix[name][day + 1] - prefix[name][max(0, day + 1 - days)]
+
+        rows = []
+        for i in range(0, size, period):
+            j = min(i + period, size) - 1
+            sums = dict((name, sum(values[i:j + 1])) for name, values in daily.items())
+            rates = {}
+            for days in (30, 90):
+                cath_days = window('cath_days', j, days)
+                clabsis = window('clabsis', j, days)
+                clancs = window('clancs', j, days)
+                rates['clabsi_rate_' + str(days)] = ratio(clabsis, cath_days, 1000)
+                rates['clanc_rate_' + str(days)] = ratio(clancs, cath_days, 1000)
+                rates['event_rate_' + str(days)] = ratio(clabsis + clancs, cath_days, 1000)
+            rows.append(TimeSeriesRow(
+                date=date.fromordinal(first + i),
+                outpatient_cath_days=sums['cath_days'] - sums['inpatient_cath_days'],
+                events=sums['clabsis'] + sums['clancs'],
+                **dict(sums, **rates)))
+        return rows
+
+
+class StratifiedSummary:
+    """Accumulates LineRow counts grouped by Line attributes while the line rows are built."""
+
+    #  LineRow fields that are summed within each group
+    SUMMED = ('line_days', 'inpatient_line_days', 'outpatient_line_days', 'lumen_days', 'clabsis',
+              'inpatient_clabsis', 'outpatient_clabsis', 'clancs', 'inpatient_clancs', 'outpatient_clancs')
+
+    def __init__(self, strata):
+        self.strata = [tuple(attrs) for attrs in strata]
+        self.attrs = []
+        for attrs in self.strata:
+            self.attrs += [a for a in attrs if a not in self.attrs]
+        self.groups = {}  # values of every stratum attribute -> line count and sums
+        self.indexes = [LineRow._fields.index(name) for name in self.SUMMED]
+
+    def add(self, line, row):
+        """Adds a Line and its LineRow to the group of its combination of attribute values."""
+        key = tuple([getattr(line, a) for a in self.attrs])
+        totals = self.groups.get(key)
+        if totals is None:
+            totals = self.groups[key] = [0] * (len(self.SUMMED) + 1)
+        totals[0] += 1
+        i = 1
+        for index in self.indexes:
+            totals[i] += row[index]
+            i += 1
+
+    def rows(self):
+        """Returns a StratumRow per group, ordered by stratum then value.
+
+        Each stratum's groups are rolled up from the groups of every attribute combination.
+        """
+        rows = []
+        for attrs in self.strata:
+            positions = [self.attrs.index(a) for a in attrs]
+            combined = {}
+            for key in sorted(self.groups, key=lambda k: [str(v) for v in k]):
+                value = tuple(key[i] for i in positions)
+                if value not in combined:
+                    combined[value] = [0] * (len(self.SUMMED) + 1)
+                combined[value] = [a + b for a, b in zip(combined[value], self.groups[key])]
+            for value in sorted(combined, key=lambda v: [str(x) for x in v]):
+                totals = combined[value]
+                sums = dict(zip(self.SUMMED, totals[1:]))
+                rows.append(StratumRow(
+                    stratum=' / '.join(attrs),
+                    value=' / '.join(str(v) for v in value),
+                    lines=totals[0],
+                    clabsi_rate=ratio(sums['clabsis'], sums['line_days'], 1000),
+                    inpatient_clabsi_rate=ratio(sums['inpatient_clabsis'], sums['inpatient_line_days'], 1000),
+                    outpatient_clabsi_rate=ratio(sums['outpatient_clabsis'], sums['outpatient_line_days'], 1000),
+                    clanc_rate=ratio(sums['clancs'], sums['line_days'], 1000),
+                    inpatient_clanc_rate=ratio(sums['inpatient_clancs'], sums['inpatient_line_days'], 1000),
+                    outpatient_clanc_rate=ratio(sums['outpatient_clancs'], sums['outpatient_line_days'], 1000),
+                    event_rate=ratio(sums['clabsis'] + sums['clancs'], sums['line_days'], 1000),
+                    **sums))
+        return rows
+
+
+def write_patient_output(title, path, results):
+    """Writes patient-only analysis to new Excel file."""
+    work_book = Workbook()
+    w_sheet = work_book.active
+
+    #  Column Titles
+    w_sheet.title = 'Output Individual Patient'
+    w_sheet.append([name for _, name in PATIENT_COLUMNS])
+
+    for r in results.patient_rows:
+        w_sheet.append(list(r))
+
+    # Summation Data
+    pop_inp = str(results.totals.inpatient_cath_days)
+    pop_out = str(results.totals.outpatient_cath_days)
+    row = len(results.patient_rows) + 2
     max_index = str(row)
     bottom = row - 1
     w_sheet['A' + max_index] = 'Population Total'
@@ -389,20 +1090,20 @@ def generate_patient_output(title, path, patients, events, start_range, end_rang
     w_sheet['I' + max_index] = '=SUM(I2:I' + str(bottom) + ')'
     w_sheet['J' + max_index] = '=SUM(J2:J' + str(bottom) + ')'
     w_sheet['K' + max_index] = '=SUM(K2:K' + str(bottom) + ')'
-    w_sheet['L' + max_index] = '=J' + max_index + '/' + str(pop_inp)
-    w_sheet['M' + max_index] = '=K' + max_index + '/' + str(pop_out)
+    w_sheet['L' + max_index] = '=J' + max_index + '/' + pop_inp
+    w_sheet['M' + max_index] = '=K' + max_index + '/' + pop_out
     w_sheet['N' + max_index] = '=I' + max_index + '/G' + max_index
     w_sheet['O' + max_index] = '=SUM(O2:O' + str(bottom) + ')'
     w_sheet['P' + max_index] = '=SUM(P2:P' + str(bottom) + ')'
     w_sheet['Q' + max_index] = '=SUM(Q2:Q' + str(bottom) + ')'
-    w_sheet['R' + max_index] = '=P' + max_index + '/' + str(pop_inp) + "* 1000"
-    w_sheet['S' + max_index] = '=Q' + max_index + '/' + str(pop_out) + "* 1000"
+    w_sheet['R' + max_index] = '=P' + max_index + '/' + pop_inp + "* 1000"
+    w_sheet['S' + max_index] = '=Q' + max_index + '/' + pop_out + "* 1000"
     w_sheet['T' + max_index] = '=O' + max_index + '/G' + max_index + "* 1000"
     w_sheet['U' + max_index] = '=SUM(U2:U' + str(bottom) + ')'
     w_sheet['V' + max_index] = '=SUM(V2:V' + str(bottom) + ')'
     w_sheet['W' + max_index] = '=SUM(W2:W' + str(bottom) + ')'
-    w_sheet['X' + max_index] = '=V' + max_index + '/' + str(pop_inp) + "* 1000"
-    w_sheet['Y' + max_index] = '=W' + max_index + '/' + str(pop_out) + "* 1000"
+    w_sheet['X' + max_index] = '=V' + max_index + '/' + pop_inp + "* 1000"
+    w_sheet['Y' + max_index] = '=W' + max_index + '/' + pop_out + "* 1000"
     w_sheet['Z' + max_index] = '=U' + max_index + '/G' + max_index + "* 1000"
     w_sheet['AA' + max_index] = '=(O' + max_index + '+ U' + max_index + ')/G' + max_index + "* 1000"
     w_sheet['AB' + max_index] = '=SUM(AB2:AB' + str(bottom) + ')'
@@ -419,132 +1120,69 @@ def generate_patient_output(title, path, patients, events, start_range, end_rang
 
     c = w_sheet['A2']
     w_sheet.freeze_panes = c
+
+    write_table_sheet(work_book.create_sheet('Data Quality'), ANOMALY_COUNT_COLUMNS, results.anomaly_counts())
+    write_table_sheet(work_book.create_sheet('Flagged Records'), ANOMALY_COLUMNS, results.anomaly_rows)
     work_book.save(path + "/" + title + " - Output Individual Patient.xlsx")
 
 
-def generate_line_output(title, path, patients, events):
+def write_line_output(title, path, results):
     """Writes line-only analysis to new Excel file."""
-    work_book = Workbook()
-    w_sheet = work_book.active
-
-    # Column Titles
-    w_sheet.title = 'Output Individual Line'
-    w_sheet['A1'] = 'Line ID'
-    w_sheet['B1'] = 'Patient ID'
-    w_sheet['C1'] = 'Number of Lumens'
-    w_sheet['D1'] = 'Date of Insertion (or first evaluation)'
-    w_sheet['E1'] = 'Date of Removal (or last evalulation)'
-    w_sheet['F1'] = 'Line Days (any catheter)'
-    w_sheet['G1'] = 'Inpatient Line Days (any catheter)'
-    w_sheet['H1'] = 'Outpatient Line Days (any catheter)'
-    w_sheet['I1'] = 'Lumen Days (Line Days x Number of Lumens)'
-    w_sheet['J1'] = 'Inpatient Lumen Days (Line Days x Number of Lumens)'
-    w_sheet['K1'] = 'Outpatient Lumen Days (Line Days x Number of Lumens)'
-
-    w_sheet['L1'] = "Number of Inpatient CLABSIs"
-    w_sheet['M1'] = "Number of Outpatient CLABSIs"
-    w_sheet['N1'] = "Total CLABSIs"
-    w_sheet['O1'] = "Number of Inpatient CLANCs"
-    w_sheet['P1'] = "Number of Outpatient CLANCs"
-    w_sheet['Q1'] = "Total CLANCs"
-    w_sheet['R1'] = "Time from CLANC to line removal (Days)"
-    w_sheet['S1'] = "Reason For Line Removal"
-
-    w_sheet['T1'] = "ALL EVENTS"
-    w_sheet['U1'] = "ALL EVENT RATE (x1000)"
-
-    w_sheet['V1'] = "Inpatient CLASBI Rate (x1000)"
-    w_sheet['W1'] = "Outpatient CLASBI Rate (x1000)"
-    w_sheet['X1'] = "Total CLASBI Rate (x1000)"
-    w_sheet['Y1'] = "Inpatient CLANC Rate (x1000)"
-    w_sheet['Z1'] = "Outpatient CLANC Rate (x1000)"
-    w_sheet['AA1'] = "Total CLANC Rate (x1000)"
-
-    row = 2
-    for p_id in patients:
-        p = patients[p_id]
-        for l in p.lines:
-            w_sheet['A' + str(row)] = l.line_id
-            w_sheet['B' + str(row)] = p_id
-            w_sheet['C' + str(row)] = l.lumens
-            w_sheet['D' + str(row)] = l.in_date
-            w_sheet['E' + str(row)] = l.out_date
-            w_sheet['F' + str(row)] = l.total_time.days
-            w_sheet['G' + str(row)] = l.inpatient_line_time
-            w_sheet['H' + str(row)] = l.total_time.days - l.inpatient_line_time
-            w_sheet['I' + str(row)] = l.lumen_days.days
-            w_sheet['J' + str(row)] = l.inpatient_lumen_time
-            w_sheet['K' + str(row)] = l.lumen_days.days - l.inpatient_lumen_time
-
-            num_inpatient = 0
-            num_outpatient = 0
-            for e in p.clabsis:
-                if l in e.lines:
-                    if e.inpatient:
-                        num_inpatient += 1 / (len(e.lines))
-                    else:
-                        num_outpatient += 1 / (len(e.lines))
-
-            w_sheet['L' + str(row)] = num_inpatient
-            w_sheet['M' + str(row)] = num_outpatient
-            w_sheet['N' + str(row)] = num_inpatient + num_outpatient
-
-            num_in_clancs = 0
-            num_out_clancs = 0
-            if l.clanc:
-                if l.clanc.inpatient:
-                    num_in_clancs = 1
-                else:
-                    num_out_clancs = 1
-                diff = datetime.date(l.out_date) - datetime.date(l.clanc.date)
-                w_sheet['R' + str(row)] = diff.days
-            else:
-                w_sheet['R' + str(row)] = "No CLANC Reported"
-            w_sheet['O' + str(row)] = num_in_clancs
-            w_sheet['P' + str(row)] = num_out_clancs
-            w_sheet['Q' + str(row)] = num_in_clancs + num_out_clancs
-
-            w_sheet['S' + str(row)] = l.removal_reason
-
-            total_events = num_in_clancs + num_out_clancs + num_inpatient + num_outpatient
-            w_sheet['T' + str(row)] = total_events
-            w_sheet['U' + str(row)] = ((total_events / l.total_time.days) * 1000) if l.total_time.days else 0
+    work_book = Workbook(write_only=True)
+    write_table_sheet(work_book.create_sheet('Output Individual Line'), LINE_COLUMNS, results.line_rows)
+    if results.stratum_rows:
+        write_table_sheet(work_book.create_sheet('Stratified Summary'), STRATUM_COLUMNS, results.stratum_rows)
+    if results.attribution_rows:
+        write_table_sheet(work_book.create_sheet('CLABSI Attribution'), ATTRIBUTION_COLUMNS, results.attribution_rows)
+    work_book.save(path + "/" + title + " - Output Individual Line.xlsx")
 
-            w_sheet['X' + str(row)] = (
-                ((num_inpatient + num_outpatient) / l.total_time.days) * 1000) if l.total_time.days else 0
-            w_sheet['AA' + str(row)] = (
-                ((num_in_clancs + num_out_clancs) / l.total_time.days) * 1000) if l.total_time.days else 0
 
-            # clasbi in/out rate
-            w_sheet['V' + str(row)] = ((num_inpatient / l.inpatient_line_time) * 1000) if l.inpatient_line_time else 0
-            w_sheet['W' + str(row)] = ((num_outpatient / (l.total_time.days - l.inpatient_line_time)) * 1000) if (
-                l.total_time.days - l.inpatient_line_time) else 0
+def write_time_series_output(title, path, results):
+    """Writes the population time series to new Excel file."""
+    work_book = Workbook(write_only=True)
+    write_table_sheet(work_book.create_sheet('Output Time Series'), TIME_SERIES_COLUMNS, results.time_series_rows)
+    work_book.save(path + "/" + title + " - Output Time Series.xlsx")
 
-            # clanc in/out rate
-            w_sheet['Y' + str(row)] = ((num_in_clancs / l.inpatient_line_time) * 1000) if l.inpatient_line_time else 0
-            w_sheet['Z' + str(row)] = ((num_out_clancs / (l.total_time.days - l.inpatient_line_time)) * 1000) if (
-                l.total_time.days - l.inpatient_line_time) else 0
-            w_sheet['D' + str(row)].number_format = 'dd-mmm-yy'
-            w_sheet['E' + str(row)].number_format = 'dd-mmm-yy'
 
-            row += 1
+def write_table_sheet(w_sheet, columns, rows):
+    """Writes a title row from columns and then each row to a worksheet.
 
+    Column widths and number formats (COLUMN_FORMATS) are decided once per column, not per cell.
+    """
     # adjust cell width for titles
     index = 1
-    for col in w_sheet.columns:
-        w_sheet.column_dimensions[get_column_letter(index)].width = max(10, len(col[0].value))
+    for _, name in columns:
+        w_sheet.column_dimensions[get_column_letter(index)].width = max(10, len(name))
         index += 1
-
-    c = w_sheet['A2']
-    w_sheet.freeze_panes = c
-    work_book.save(path + "/" + title + " - Output Individual Line.xlsx")
+    w_sheet.freeze_panes = 'A2'
+
+    w_sheet.append([name for _, name in columns])
+    formatted = [(i, COLUMN_FORMATS[field]) for i, (field, _) in enumerate(columns) if field in COLUMN_FORMATS]
+    if not formatted:
+        for r in rows:
+            w_sheet.append(r)
+        return
+    for r in rows:
+        r = list(r)
+        for i, number_format in formatted:
+            c = WriteOnlyCell(w_sheet, r[i])
+            c.number_format = number_format
+            r[i] = c
+        w_sheet.append(r)
 
 
 def calculate_total_cath_days(p, start_range, end_range):
     """Returns the total number of days a Patient has ANY catheter."""
-    sorted(p.lines)
+    cath_days, inpatient_cath_days = calculate_cath_day_sets(p, start_range, end_range)
+    inp_cath_days = len(inpatient_cath_days)
+    total_cath_days = len(cath_days)
+    return [total_cath_days, inp_cath_days, total_cath_days - inp_cath_days]
+
+
+def calculate_cath_day_sets(p, start_range, end_range):
+    """Returns the sets of dates a Patient has ANY catheter and has ANY catheter as an inpatient."""
     lines_in_range = []
-    for l in p.lines:
+    for l in sorted(p.lines):
         if l.out_date < start_range:
             continue
         elif l.in_date > end_range:
@@ -579,9 +1217,7 @@ def calculate_total_cath_days(p, start_range, end_range):
                 tmp = [timedelta(days=d) + v.check_in_date for d in range((end - v_start).days)]
 
                 inpatient_cath_days += [date(d.year, d.month, d.day) for d in tmp]
-    inp_cath_days = len(set(inpatient_cath_days))
-    total_cath_days = len(set(date_range))
-    return [total_cath_days, inp_cath_days, total_cath_days - inp_cath_days]
+    return set(date_range), set(inpatient_cath_days)
 
 
 def calculate_inpatient_line_days(p, start_range, end_range):
@@ -635,6 +1271,23 @@ class Patient:
         else:
             self.total_visit_time += v.total_time
 
+    def clear_attribution(self):
+        """Removes the Patient's visits and events and the inpatient days calculated from them.
+
+        The lines are kept, so visits and events can be read again under other attribution Rules.
+        """
+        self.visits = []
+        self.clabsis = []
+        self.clancs = []
+        self.total_visit_time = timedelta(0)
+        self.inpatient_line_time = 0
+        self.inpatient_lumen_time = 0
+        for l in self.lines:
+            l.clabsis = []
+            l.clanc = None
+            l.inpatient_line_time = 0
+            l.inpatient_lumen_time = 0
+
     def add_line(self, l):
         """Adds a Line object to the list of Visits and adds the time to total_line_time."""
         assert isinstance(l, Line), "new lines must be of type Line"
@@ -684,20 +1337,25 @@ class Line:
     def __lt__(self, other):
         if self.in_date == other.in_date:
             return self.out_date < other.out_date
-        return self.in_date < self.out_date
+        return self.in_date < other.in_date
 
     def __eq__(self, other):
         return self.in_date == other.in_date and self.out_date == other.out_date
 
 
 class CLABSI:
-    """Class for CLABSI event. used becuase required infectious information is more complicated"""
+    """Class for CLABSI event. used becuase required infectious information is more complicated
+
+    The event is shared equally by every line in place on its date: weight is the fraction credited
+    to each line, and each of those lines lists the event in Line.clabsis.
+    """
 
     def __init__(self, patient, lines, date):
         self.patient = patient
         self.lines = lines
         self.date = date
         self.inpatient = False
+        self.weight = 1 / len(lines) if lines else 0
 
 
 class CLANC: